@@ -1,6 +1,7 @@
 import os
+from pydantic import field_validator
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Literal
 
 class Settings(BaseSettings):
     # PostgreSQL数据库连接配置
@@ -19,6 +20,10 @@ class Settings(BaseSettings):
     upload_dir: str = "./uploads"
     max_file_size: int = 10 * 1024 * 1024  # 10MB
     allowed_extensions: str = "jpg,jpeg,png,webp"
+    deep_validate_images: bool = os.getenv("DEEP_VALIDATE_IMAGES", "false").lower() == "true"  # 是否额外用PIL校验上传图像
+    max_image_pixels: int = int(os.getenv("MAX_IMAGE_PIXELS", "50000000"))  # 上传图像最大像素数（宽x高），解码前检查
+    lossless_output_format: Literal["png", "webp"] = os.getenv("LOSSLESS_OUTPUT_FORMAT", "png").lower()  # 非JPEG输入的处理结果格式：png 或 webp（无损，编码更快、体积更小）
+    decode_cache_max_mb: int = int(os.getenv("DECODE_CACHE_MAX_MB", "64"))  # 每个进程缓存解码结果的内存上限（MB），0为关闭缓存
     
     # 邮箱配置
     smtp_host: str = os.getenv("SMTP_HOST", "smtp.qq.com")  # QQ邮箱SMTP服务器
@@ -47,6 +52,9 @@ class Settings(BaseSettings):
     comfyui_upscale_workflow: str = os.getenv("COMFYUI_UPSCALE_WORKFLOW", "workflow/upscale_0801.json")
     comfyui_input_dir: str = os.getenv("COMFYUI_INPUT_DIR", "./comfyui_temp")  # ComfyUI输入文件目录
     comfyui_timeout: int = int(os.getenv("COMFYUI_TIMEOUT", "120"))
+    comfyui_max_concurrency: int = int(os.getenv("COMFYUI_MAX_CONCURRENCY", "4"))  # 同时提交到ComfyUI的任务数上限，超出的请求排队等待
+    comfyui_max_batch: int = int(os.getenv("COMFYUI_MAX_BATCH", "1"))  # 文生图攒批上限：参数相同的请求合并为一个batch任务，1为不攒批（批越大占用显存越多）
+    comfyui_batch_window_ms: int = int(os.getenv("COMFYUI_BATCH_WINDOW_MS", "50"))  # 攒批等待窗口（毫秒）
     
     # Redis配置
     redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379")
@@ -58,6 +66,12 @@ class Settings(BaseSettings):
     face_swap_api_url: str = os.getenv("FACE_SWAP_API_URL", "https://u227558-b71f-4cfbc0f8.westc.gpuhub.com:8443")
     face_swap_timeout: int = int(os.getenv("FACE_SWAP_TIMEOUT", "300"))  # 5分钟超时
 
+    @field_validator("lossless_output_format", mode="before")
+    @classmethod
+    def _lowercase_output_format(cls, value):
+        """环境变量和.env中的格式名不区分大小写，其他取值在启动时直接报错"""
+        return value.lower() if isinstance(value, str) else value
+    
     @property
     def allowed_extensions_list(self) -> List[str]:
         return [ext.strip().lower() for ext in self.allowed_extensions.split(",")]
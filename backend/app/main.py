@@ -20,37 +20,40 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+logger = logging.getLogger(__name__)
+
 # Add request logging middleware
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     start_time = time.time()
     
     try:
-        # Log request details
-        print(f"🔵 [REQUEST] {request.method} {request.url}")
-        print(f"🔵 [HEADERS] {dict(request.headers)}")
-        
-        # For POST requests, try to log body (handle carefully)
-        if request.method == "POST":
-            try:
-                body = await request.body()
-                if len(body) < 1000:  # Only log small bodies
-                    print(f"🔵 [BODY] {body.decode('utf-8', errors='ignore')}")
-            except Exception as e:
-                print(f"🔵 [BODY ERROR] {e}")
+        # Log request details (headers and bodies only when DEBUG is enabled)
+        logger.info("Request: %s %s", request.method, request.url)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Headers: %s", dict(request.headers))
+            
+            # For POST requests, try to log body (handle carefully)
+            if request.method == "POST":
+                try:
+                    body = await request.body()
+                    if len(body) < 1000:  # Only log small bodies
+                        logger.debug("Body: %s", body.decode('utf-8', errors='ignore'))
+                except Exception as e:
+                    logger.debug("Body read error: %s", e)
         
         # Process request
         response = await call_next(request)
         
         # Log response time
         process_time = time.time() - start_time
-        print(f"🟢 [RESPONSE] Status: {response.status_code}, Time: {process_time:.3f}s")
+        logger.info("Response: status=%s time=%.3fs", response.status_code, process_time)
         
         return response
     except Exception as e:
         # Log middleware errors
         process_time = time.time() - start_time
-        print(f"🔴 [MIDDLEWARE ERROR] {str(e)}, Time: {process_time:.3f}s")
+        logger.error("Middleware error: %s, time=%.3fs", e, process_time)
         # Re-raise exception for FastAPI's exception handler
         raise
 
@@ -164,6 +167,18 @@ async def startup_event():
     else:
         print("⚠️ Redis连接失败，将使用降级模式（无缓存）")
     
+    # 图像编解码库检查：JPEG解码/编码速度主要取决于Pillow链接的是否为libjpeg-turbo
+    from PIL import Image, features
+    import cv2
+    print("🔍 图像编解码库检查:")
+    print(f"   Pillow: {Image.__version__}（.post 后缀为 Pillow-SIMD 构建）")
+    if features.check_feature("libjpeg_turbo"):
+        print(f"✅ JPEG: libjpeg-turbo {features.version('libjpeg_turbo')}")
+    else:
+        print(f"⚠️ JPEG: libjpeg {features.version('jpg')}（非libjpeg-turbo，JPEG编解码会明显变慢）")
+    print(f"   zlib: {features.version('zlib')}")
+    print(f"   OpenCV: {cv2.__version__}，优化内核{'已启用' if cv2.useOptimized() else '未启用'}")
+    
     # Check upload directory status
     if os.path.exists(upload_dir) and os.access(upload_dir, os.W_OK):
         print(f"✅ Upload directory writable: {upload_dir}")
@@ -180,6 +195,10 @@ async def startup_event():
 async def shutdown_event():
     """Cleanup when application shuts down"""
     print("👋 Ghibli AI Backend shutting down...")
+    
+    # 关闭共享的HTTP连接池
+    from app.utils.http_client import close_session
+    await close_session()
 
 @app.api_route("/", methods=["GET", "HEAD"])
 async def root(request: Request):
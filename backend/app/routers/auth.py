@@ -12,7 +12,7 @@ from app.models.schemas import (
 )
 from app.utils.auth import verify_password, get_password_hash, create_access_token, verify_token
 from app.utils.email import send_verification_email, generate_verification_code
-from app.utils.credits import check_user_credits, deduct_user_credits
+from app.utils.credits import check_user_credits, deduct_user_credits_atomic
 from app.utils.redis_client import user_cache_manager
 from app.config import settings
 
@@ -425,19 +425,12 @@ async def deduct_credits(
     db: Session = Depends(get_db)
 ):
     """扣除用户积分（下载时调用）"""
-    if not check_user_credits(current_user, request.cost):
+    if deduct_user_credits_atomic(db, current_user, request.cost) is None:
         raise HTTPException(
             status_code=400,
             detail=f"积分不足，当前积分：{current_user.credits}，需要积分：{request.cost}"
         )
     
-    success = deduct_user_credits(db, current_user, request.cost)
-    if not success:
-        raise HTTPException(
-            status_code=400,
-            detail="积分扣除失败"
-        )
-    
     return CreditResponse(
         success=True,
         message=f"成功扣除{request.cost}积分，剩余积分：{current_user.credits}",
@@ -1,35 +1,68 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Form, Depends
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, UploadFile, File, HTTPException, Form, Depends, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from typing import Optional
+from email.utils import formatdate
 import os
+import stat
+import shutil
+import tempfile
+import urllib.parse
+from functools import lru_cache
 import json
-import io
-from PIL import Image
-import requests
 import time
 import uuid
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import logging
 
-from app.models.schemas import ImageProcessResponse, ErrorResponse, TextToImageAsyncResponse, ProgressResponse, CreditResponse
+# 带SIMD加速的pybase64，接口与标准库 base64 兼容
+import pybase64 as base64
+
+from app.models.schemas import ImageProcessResponse
 from app.models.models import User
 from app.database import get_db
 from app.routers.auth import get_current_user
-from app.utils.credits import check_user_credits, deduct_user_credits
+from app.utils.credits import deduct_user_credits_atomic
+from app.utils.http_client import get_session
 from app.services.image_processing import image_processing_service
 from app.utils.file_utils import (
     validate_image_file, 
-    save_uploaded_file, 
     save_processed_image, 
     get_file_url,
     cleanup_file
 )
 from app.config import settings
-from app.utils.redis_client import task_progress_manager, comfyui_cache_manager
+from app.utils.redis_client import redis_client, task_progress_manager, comfyui_cache_manager
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# 上传目录的真实路径（解析符号链接），用于防止目录穿越
+_UPLOADS_DIR_ABS = os.path.realpath(settings.upload_dir)
+_UPLOADS_PREFIX = os.path.join(_UPLOADS_DIR_ABS, '')
+
+def _resolve_upload_path(decoded_filename: str) -> str:
+    """
+    将文件名解析为上传目录中的真实路径
+    
+    使用realpath解析符号链接，确保最终路径位于上传目录内
+    
+    Args:
+        decoded_filename: 已解码的文件名
+        
+    Returns:
+        str: 文件的真实路径
+    """
+    raw_path = os.path.normpath(os.path.join(_UPLOADS_DIR_ABS, decoded_filename))
+    file_path = os.path.realpath(raw_path)
+    if not file_path.startswith(_UPLOADS_PREFIX):
+        logger.warning("Path traversal attempt: %s", file_path)
+        raise HTTPException(status_code=400, detail="无效的文件路径")
+    return file_path
+
 # 任务进度现在使用Redis存储，不再需要内存字典
 # task_progress = {}  # 已替换为Redis
 
@@ -58,6 +91,10 @@ async def get_task_progress(task_id: str):
         task_progress_manager.delete_progress(task_id)
         raise HTTPException(status_code=404, detail="任务已过期")
     
+    return _progress_payload(task_id, progress_info)
+
+def _progress_payload(task_id: str, progress_info: dict) -> dict:
+    """将Redis中的任务进度转换为接口返回格式"""
     return {
         "success": True,
         "task_id": task_id,
@@ -68,6 +105,80 @@ async def get_task_progress(task_id: str):
         "error": progress_info.get('error', None)
     }
 
+# SSE心跳间隔（秒），防止代理因空闲断开连接
+_SSE_KEEPALIVE_SECONDS = 30
+# 单个SSE连接的最长持续时间（秒），与进度记录的过期时间一致
+_SSE_MAX_SECONDS = 600
+
+@router.get("/progress/{task_id}/stream")
+async def stream_task_progress(task_id: str, request: Request):
+    """
+    以Server-Sent Events推送任务进度
+    
+    订阅任务的Redis发布频道，进度变化时立即推送，任务结束、进度记录过期
+    或连接超过最长持续时间后关闭连接。
+    无法使用SSE的客户端可以继续轮询 /progress/{task_id}
+    
+    Args:
+        task_id: 任务ID
+        request: 请求对象（用于检测客户端断开）
+        
+    Returns:
+        StreamingResponse: text/event-stream响应
+    """
+    pubsub = redis_client.pubsub_async()
+    if pubsub is None:
+        raise HTTPException(status_code=503, detail="进度推送不可用，请使用轮询接口")
+    
+    # 先订阅再读取当前进度，避免错过两者之间发布的更新
+    await pubsub.subscribe(task_progress_manager.channel(task_id))
+    progress_info = task_progress_manager.get_progress(task_id)
+    if not progress_info:
+        await pubsub.aclose()
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    
+    def format_event(info: dict) -> str:
+        payload = _progress_payload(task_id, info)
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    
+    async def event_generator():
+        try:
+            yield format_event(progress_info)
+            status = progress_info.get('status')
+            deadline = time.monotonic() + _SSE_MAX_SECONDS
+            while status not in ('completed', 'failed'):
+                if await request.is_disconnected():
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True,
+                    timeout=min(_SSE_KEEPALIVE_SECONDS, remaining)
+                )
+                if message is None:
+                    # 长时间没有推送：任务可能已过期，或结束消息在订阅前后丢失，重新读取一次
+                    info = await run_in_threadpool(task_progress_manager.get_progress, task_id)
+                    if not info:
+                        break
+                    status = info.get('status')
+                    if status in ('completed', 'failed'):
+                        yield format_event(info)
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                info = json.loads(message['data'])
+                status = info.get('status')
+                yield format_event(info)
+        finally:
+            await pubsub.aclose()
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.get("/processors")
 async def get_available_processors():
     """
@@ -107,15 +218,17 @@ async def get_comfyui_models():
         if settings.comfyui_token:
             headers['Authorization'] = f'Bearer {settings.comfyui_token}'
         
-        # 请求ComfyUI的模型列表
-        response = requests.get(
+        # 请求ComfyUI的模型列表（走共享的异步连接池，不阻塞事件循环）
+        session = await get_session()
+        async with session.get(
             f"http://{settings.comfyui_server_address}/object_info", 
             headers=headers,
-            timeout=30
-        )
+            timeout=aiohttp.ClientTimeout(total=30)
+        ) as response:
+            status_code = response.status
+            object_info = await response.json(content_type=None) if status_code == 200 else None
         
-        if response.status_code == 200:
-            object_info = response.json()
+        if status_code == 200:
             
             # 提取CheckpointLoaderSimple的可用模型
             checkpoint_loader = object_info.get("CheckpointLoaderSimple", {})
@@ -139,14 +252,14 @@ async def get_comfyui_models():
                 "from_cache": False
             }
         else:
-            print(f"ComfyUI模型列表请求失败: {response.status_code}")
+            print(f"ComfyUI模型列表请求失败: {status_code}")
             return {
                 "success": False,
                 "models": [],
-                "message": f"获取模型列表失败: HTTP {response.status_code}"
+                "message": f"获取模型列表失败: HTTP {status_code}"
             }
             
-    except requests.exceptions.ConnectionError:
+    except aiohttp.ClientConnectionError:
         print("无法连接到ComfyUI服务器")
         return {
             "success": False,
@@ -161,21 +274,46 @@ async def get_comfyui_models():
             "message": f"获取模型列表时出错: {str(e)}"
         }
 
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断If-None-Match头是否命中ETag（弱比较，支持多个值和*）"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(','))
+    return any(tag.removeprefix('W/') == etag for tag in candidates)
+
+@lru_cache(maxsize=1024)
+def _content_disposition(attachment: bool, name: str) -> str:
+    """
+    生成Content-Disposition头
+    
+    纯ASCII且无需转义的文件名直接使用filename="..."；
+    其他文件名使用RFC 5987的filename*=UTF-8''编码，并附带ASCII降级文件名
+    """
+    disposition = "attachment" if attachment else "inline"
+    if name.isascii() and name.isprintable() and '"' not in name and '\\' not in name:
+        return f'{disposition}; filename="{name}"'
+    
+    ascii_name = name.encode('ascii', 'ignore').decode('ascii').replace('"', '').replace('\\', '')
+    return f"{disposition}; filename*=UTF-8''{urllib.parse.quote(name)}; filename=\"{ascii_name}\""
+
 @router.get("/files/{filename}")
-async def get_file(filename: str):
+async def get_file(filename: str, request: Request):
     """
     获取处理后的文件（用于图片预览，无需登录）
-    支持包含特殊字符的文件名
+    支持包含特殊字符的文件名，支持基于ETag的条件请求（304）
+    以及Range/If-Range分段请求（206，由FileResponse处理）
     
     Args:
         filename: 文件名（可能包含URL编码）
+        request: 请求对象（用于读取If-None-Match头）
         
     Returns:
         FileResponse: 文件响应
     """
     try:
         # URL decode the filename to handle special characters
-        import urllib.parse
         decoded_filename = urllib.parse.unquote(filename, encoding='utf-8')
         
         # Additional decoding for double-encoded filenames
@@ -185,20 +323,30 @@ async def get_file(filename: str):
             pass  # If second decode fails, use first result
         
         # Log the filename handling for debugging
-        print(f"🔍 [FILE ACCESS] Original: '{filename}' -> Decoded: '{decoded_filename}'")
+        logger.debug("File access: %r -> %r", filename, decoded_filename)
         
         # Ensure the file path is safe and within the uploads directory
-        file_path = os.path.abspath(os.path.join(settings.upload_dir, decoded_filename))
-        uploads_dir = os.path.abspath(settings.upload_dir)
-        
-        # Security check to prevent directory traversal
-        if not file_path.startswith(uploads_dir):
-            print(f"🚨 [SECURITY] Path traversal attempt: {file_path}")
-            raise HTTPException(status_code=400, detail="无效的文件路径")
+        file_path = _resolve_upload_path(decoded_filename)
         
-        if not os.path.exists(file_path):
-            print(f"❌ [FILE NOT FOUND] Path: {file_path}")
+        # Stat once: used for the 404 check, the validators and FileResponse itself
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            logger.info("File not found: %s", file_path)
             raise HTTPException(status_code=404, detail=f"文件不存在: {decoded_filename}")
+        
+        # Conditional GET: browsers revalidating a cached image get a bodiless 304.
+        # The ETag is strong so that it can also be used in If-Range to resume
+        # partial downloads (weak validators never satisfy If-Range).
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        if _etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(
+                status_code=304,
+                headers={"ETag": etag, "Last-Modified": last_modified, "Accept-Ranges": "bytes"}
+            )
 
         # Determine media type based on file extension
         file_extension = decoded_filename.lower().split('.')[-1] if '.' in decoded_filename else 'png'
@@ -211,14 +359,18 @@ async def get_file(filename: str):
         }
         media_type = media_type_map.get(file_extension, 'image/png')
         
-        print(f"✅ [FILE SERVED] Path: {file_path}, Type: {media_type}")
+        logger.debug("File served: %s (%s)", file_path, media_type)
         
         # Return file with appropriate headers for special characters
         return FileResponse(
             file_path,
             media_type=media_type,
+            stat_result=st,
             headers={
-                "Content-Disposition": f"inline; filename*=UTF-8''{urllib.parse.quote(decoded_filename)}"
+                "Content-Disposition": _content_disposition(False, decoded_filename),
+                "ETag": etag,
+                "Last-Modified": last_modified,
+                "Accept-Ranges": "bytes"
             }
         )
         
@@ -226,8 +378,7 @@ async def get_file(filename: str):
         raise
     except Exception as e:
         # Log the error for debugging
-        print(f"🔴 [FILE ERROR] Error in get_file: {str(e)}")
-        print(f"🔴 [FILE ERROR] Original filename: '{filename}'")
+        logger.error("Error in get_file for %r: %s", filename, e)
         raise HTTPException(status_code=500, detail=f"获取文件时出错: {str(e)}")
 
 @router.get("/download/{filename}")
@@ -250,7 +401,6 @@ async def download_file(
     """
     try:
         # URL decode the filename to handle special characters
-        import urllib.parse
         decoded_filename = urllib.parse.unquote(filename, encoding='utf-8')
         
         # Additional decoding for double-encoded filenames
@@ -260,36 +410,22 @@ async def download_file(
             pass  # If second decode fails, use first result
         
         # Log the download request
-        print(f"🔍 [DOWNLOAD] User: {current_user.email}, File: '{decoded_filename}'")
+        logger.debug("Download requested by %s: %r", current_user.email, decoded_filename)
         
         # Ensure the file path is safe and within the uploads directory
-        file_path = os.path.abspath(os.path.join(settings.upload_dir, decoded_filename))
-        uploads_dir = os.path.abspath(settings.upload_dir)
-        
-        # Security check to prevent directory traversal
-        if not file_path.startswith(uploads_dir):
-            print(f"🚨 [SECURITY] Download path traversal attempt: {file_path}")
-            raise HTTPException(status_code=400, detail="无效的文件路径")
+        file_path = _resolve_upload_path(decoded_filename)
         
         if not os.path.exists(file_path):
-            print(f"❌ [DOWNLOAD] File not found: {file_path}")
+            logger.info("Download file not found: %s", file_path)
             raise HTTPException(status_code=404, detail=f"文件不存在: {decoded_filename}")
         
-        # 检查积分是否足够
+        # 检查并扣除积分（单条原子UPDATE）
         required_credits = 10
-        if not check_user_credits(current_user, required_credits):
+        if deduct_user_credits_atomic(db, current_user, required_credits) is None:
             raise HTTPException(
                 status_code=400, 
                 detail=f"积分不足，当前积分：{current_user.credits}，需要积分：{required_credits}"
             )
-        
-        # 扣除积分
-        success = deduct_user_credits(db, current_user, required_credits)
-        if not success:
-            raise HTTPException(
-                status_code=400,
-                detail="积分扣除失败"
-            )
 
         # Determine media type based on file extension
         file_extension = decoded_filename.lower().split('.')[-1] if '.' in decoded_filename else 'png'
@@ -303,12 +439,11 @@ async def download_file(
         media_type = media_type_map.get(file_extension, 'image/png')
         
         # Create proper headers for download with special character support
-        safe_filename = urllib.parse.quote(decoded_filename)
         headers = {
-            "Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}; filename=\"{decoded_filename.encode('ascii', 'ignore').decode('ascii')}\""
+            "Content-Disposition": _content_disposition(True, decoded_filename)
         }
         
-        print(f"✅ [DOWNLOAD] File served: {file_path}")
+        logger.debug("Download served: %s", file_path)
         
         return FileResponse(
             file_path,
@@ -320,8 +455,7 @@ async def download_file(
         raise
     except Exception as e:
         # Log the error for debugging
-        print(f"🔴 [DOWNLOAD ERROR] Error in download_file: {str(e)}")
-        print(f"🔴 [DOWNLOAD ERROR] Original filename: '{filename}'")
+        logger.error("Error in download_file for %r: %s", filename, e)
         raise HTTPException(status_code=500, detail=f"下载文件时出错: {str(e)}")
 
 @router.post("/process", response_model=ImageProcessResponse)
@@ -346,21 +480,13 @@ async def process_image(
         ImageProcessResponse: 处理结果
     """
     try:
-        # 检查积分是否足够
+        # 检查并扣除积分（单条原子UPDATE）
         required_credits = 10
-        if not check_user_credits(current_user, required_credits):
+        if deduct_user_credits_atomic(db, current_user, required_credits) is None:
             raise HTTPException(
                 status_code=400, 
                 detail=f"积分不足，当前积分：{current_user.credits}，需要积分：{required_credits}。请充值后再试。"
             )
-            
-        # 扣除积分
-        success = deduct_user_credits(db, current_user, required_credits)
-        if not success:
-            raise HTTPException(
-                status_code=400,
-                detail="积分扣除失败"
-            )
         
         # 验证文件
         if not validate_image_file(file):
@@ -385,7 +511,7 @@ async def process_image(
         
         # 处理图像
         try:
-            processed_data, processing_time = image_processing_service.process_image(
+            processed_data, processing_time = await image_processing_service.process_image(
                 file_content, 
                 processing_type, 
                 process_parameters
@@ -399,7 +525,9 @@ async def process_image(
             )
         
         # 保存处理后的图像
-        processed_file_path = save_processed_image(
+        # 写文件并fsync，放到线程池中执行，不阻塞事件循环
+        processed_file_path = await run_in_threadpool(
+            save_processed_image,
             processed_data, 
             file.filename or "image"
         )
@@ -423,46 +551,77 @@ async def process_image(
             detail=f"服务器内部错误: {str(e)}"
         )
 
-@router.post("/ghibli-style-async")
-async def ghibli_style_async(
-    file: UploadFile = File(..., description="要转换的图像文件"),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
+# 各类异步任务在进度、日志中使用的提示文案
+_GHIBLI_TASK_MESSAGES = {
+    'pending': '任务已创建，准备转换为吉卜力风格...',
+    'created': '吉卜力风格转换任务已创建',
+    'create_failed': '创建吉卜力风格转换任务失败',
+    'running': '开始转换为吉卜力风格...',
+    'completed': '吉卜力风格转换完成',
+    'failed': '吉卜力风格转换失败',
+    'log_tag': 'GHIBLI ASYNC TASK'
+}
+
+_PROCESS_TASK_MESSAGES = {
+    'pending': '任务已创建，准备处理...',
+    'created': '任务已创建',
+    'create_failed': '创建任务失败',
+    'running': '开始处理图像...',
+    'completed': '处理完成',
+    'failed': '处理失败',
+    'log_tag': 'ASYNC TASK'
+}
+
+_TEXT_TO_IMAGE_TASK_MESSAGES = {
+    'pending': '任务已创建，准备生成图像...',
+    'created': '文生图任务已创建',
+    'create_failed': '创建文生图任务失败',
+    'running': '开始生成图像...',
+    'completed': '图像生成完成',
+    'failed': '生成失败',
+    'log_tag': 'TEXT-TO-IMAGE TASK'
+}
+
+async def _spawn_processing_task(
+    processing_type: str,
+    file: Optional[UploadFile],
+    parameters: dict,
+    *,
+    filename: str,
+    estimated_time: int,
+    messages: dict,
+    current_user: User,
+    db: Session
+) -> dict:
     """
-    异步吉卜力风格转换端点（支持进度跟踪）
+    创建异步处理任务的公共流程
+    
+    检查并扣除积分、验证文件、初始化任务进度，然后启动后台任务
     
     Args:
-        file: 上传的图像文件
+        processing_type: 处理类型
+        file: 上传的图像文件（文生图时为None）
+        parameters: 处理参数
+        filename: 保存结果时使用的原始文件名
+        estimated_time: 预估耗时（秒）
+        messages: 任务提示文案
         current_user: 当前登录用户
         db: 数据库会话
     
     Returns:
-        AsyncTaskResponse: 任务ID和状态
+        dict: 任务ID和状态
     """
-    import uuid
-    import asyncio
-    from concurrent.futures import ThreadPoolExecutor
-    
     try:
-        # 检查积分是否足够
+        # 检查并扣除积分（单条原子UPDATE）
         required_credits = 10
-        if not check_user_credits(current_user, required_credits):
+        if deduct_user_credits_atomic(db, current_user, required_credits) is None:
             raise HTTPException(
                 status_code=400, 
                 detail=f"积分不足，当前积分：{current_user.credits}，需要积分：{required_credits}。请充值后再试。"
             )
-            
-        # 扣除积分
-        success = deduct_user_credits(db, current_user, required_credits)
-        if not success:
-            raise HTTPException(
-                status_code=400,
-                detail="积分扣除失败"
-            )
         
         # 验证文件
-        if not validate_image_file(file):
+        if file is not None and not validate_image_file(file):
             raise HTTPException(
                 status_code=400, 
                 detail="无效的图像文件或文件过大"
@@ -475,25 +634,25 @@ async def ghibli_style_async(
         task_progress_manager.set_progress(task_id, {
             'status': 'pending',
             'progress': 0,
-            'message': '任务已创建，准备转换为吉卜力风格...',
+            'message': messages['pending'],
             'result_url': None,
             'error': None,
             'created_at': time.time()
         })
         
-        # 读取文件内容
-        file_content = await file.read()
+        # 将上传内容转存到临时文件，后台任务只持有路径（文生图不需要输入图像）
+        tmp_path = await run_in_threadpool(_spool_upload, file) if file is not None else None
         
         # 启动后台任务
-        asyncio.create_task(ghibli_style_background(
-            task_id, file_content, file.filename or "image"
+        asyncio.create_task(_processing_background(
+            task_id, tmp_path, processing_type, parameters, filename, messages
         ))
         
         return {
             "success": True,
-            "message": "吉卜力风格转换任务已创建",
+            "message": messages['created'],
             "task_id": task_id,
-            "estimated_time": 90  # 预估1.5分钟
+            "estimated_time": estimated_time
         }
         
     except HTTPException:
@@ -501,59 +660,114 @@ async def ghibli_style_async(
     except Exception as e:
         raise HTTPException(
             status_code=500,
-            detail=f"创建吉卜力风格转换任务失败: {str(e)}"
+            detail=f"{messages['create_failed']}: {str(e)}"
         )
 
-async def ghibli_style_background(task_id: str, file_content: bytes, filename: str):
+def _spool_upload(file: UploadFile) -> str:
+    """
+    将上传文件写入临时文件
+    
+    后台任务可能运行数分钟，只传递路径可避免整张图像在任务期间常驻内存
+    
+    Returns:
+        str: 临时文件路径（由后台任务负责删除）
+    """
+    file.file.seek(0)
+    with tempfile.NamedTemporaryFile(prefix="task_upload_", delete=False) as tmp:
+        shutil.copyfileobj(file.file, tmp)
+    return tmp.name
+
+def _read_spooled_file(tmp_path: Optional[str]) -> bytes:
+    """读取后台任务的临时文件（文生图没有输入图像时返回空字节）"""
+    if not tmp_path:
+        return b''
+    with open(tmp_path, 'rb') as f:
+        return f.read()
+
+async def _processing_background(
+    task_id: str,
+    tmp_path: Optional[str],
+    processing_type: str,
+    parameters: dict,
+    filename: str,
+    messages: dict
+):
     """
-    后台吉卜力风格转换任务
+    后台图像处理任务
+    
+    Redis进度写入、读写临时文件都是同步调用，一律放到线程池中执行，不阻塞事件循环
     """
     try:
-        # 更新任务状态（使用Redis）
-        task_progress_manager.update_progress(task_id, {
+        # 更新任务状态
+        await run_in_threadpool(task_progress_manager.update_progress, task_id, {
             'status': 'running',
             'progress': 10,
-            'message': '开始转换为吉卜力风格...'
+            'message': messages['running']
         })
         
-        # 在线程池中执行图像处理（因为图像处理是CPU密集型任务）
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            processed_data, processing_time = await loop.run_in_executor(
-                executor,
-                image_processing_service.process_image,
-                file_content,
-                'ghibli_style',
-                {},
-                task_id  # 传递task_id用于进度更新
-            )
+        # 执行图像处理（服务内部会把阻塞操作放到线程中执行）
+        file_content = await run_in_threadpool(_read_spooled_file, tmp_path)
+        processed_data, processing_time = await image_processing_service.process_image(
+            file_content,
+            processing_type,
+            parameters,
+            task_id  # 传递task_id用于进度更新
+        )
         
         # 保存处理后的图像
-        processed_file_path = save_processed_image(processed_data, filename)
+        processed_file_path = await run_in_threadpool(save_processed_image, processed_data, filename)
         
         # 生成访问URL
         processed_image_url = get_file_url(processed_file_path)
         
         # 更新任务完成状态
-        task_progress_manager.update_progress(task_id, {
+        await run_in_threadpool(task_progress_manager.update_progress, task_id, {
             'status': 'completed',
             'progress': 100,
-            'message': '吉卜力风格转换完成',
+            'message': messages['completed'],
             'result_url': processed_image_url,
             'completed_at': time.time()
         })
         
     except Exception as e:
         # 更新任务失败状态
-        task_progress_manager.update_progress(task_id, {
+        await run_in_threadpool(task_progress_manager.update_progress, task_id, {
             'status': 'failed',
             'progress': 0,
-            'message': '吉卜力风格转换失败',
+            'message': messages['failed'],
             'error': str(e)
         })
-        print(f"❌ [GHIBLI ASYNC TASK] Task {task_id} failed: {str(e)}")
-
+        print(f"❌ [{messages['log_tag']}] Task {task_id} failed: {str(e)}")
+    finally:
+        # 删除上传内容的临时文件
+        if tmp_path:
+            await run_in_threadpool(cleanup_file, tmp_path)
 
+@router.post("/ghibli-style-async")
+async def ghibli_style_async(
+    file: UploadFile = File(..., description="要转换的图像文件"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    异步吉卜力风格转换端点（支持进度跟踪）
+    
+    Args:
+        file: 上传的图像文件
+        current_user: 当前登录用户
+        db: 数据库会话
+    
+    Returns:
+        AsyncTaskResponse: 任务ID和状态
+    """
+    return await _spawn_processing_task(
+        'ghibli_style', file, {},
+        filename=file.filename or "image",
+        estimated_time=90,  # 预估1.5分钟
+        messages=_GHIBLI_TASK_MESSAGES,
+        current_user=current_user,
+        db=db
+    )
 
 @router.post("/process-async")
 async def process_image_async(
@@ -576,129 +790,25 @@ async def process_image_async(
     Returns:
         AsyncTaskResponse: 任务ID和状态
     """
-    import uuid
-    import asyncio
-    from concurrent.futures import ThreadPoolExecutor
-    
-    try:
-        # 检查积分是否足够
-        required_credits = 10
-        if not check_user_credits(current_user, required_credits):
-            raise HTTPException(
-                status_code=400, 
-                detail=f"积分不足，当前积分：{current_user.credits}，需要积分：{required_credits}。请充值后再试。"
-            )
-            
-        # 扣除积分
-        success = deduct_user_credits(db, current_user, required_credits)
-        if not success:
+    # 解析参数（在扣除积分之前，避免参数错误也被扣费）
+    process_parameters = {}
+    if parameters:
+        try:
+            process_parameters = json.loads(parameters)
+        except json.JSONDecodeError:
             raise HTTPException(
                 status_code=400,
-                detail="积分扣除失败"
-            )
-        
-        # 验证文件
-        if not validate_image_file(file):
-            raise HTTPException(
-                status_code=400, 
-                detail="无效的图像文件或文件过大"
+                detail="参数格式错误，应为有效的JSON字符串"
             )
-        
-        # 生成任务ID
-        task_id = str(uuid.uuid4())
-        
-        # 初始化任务进度
-        task_progress_manager.set_progress(task_id, {
-            'status': 'pending',
-            'progress': 0,
-            'message': '任务已创建，准备处理...',
-            'result_url': None,
-            'error': None,
-            'created_at': time.time()
-        })
-        
-        # 解析参数
-        process_parameters = {}
-        if parameters:
-            try:
-                process_parameters = json.loads(parameters)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=400,
-                    detail="参数格式错误，应为有效的JSON字符串"
-                )
-        
-        # 读取文件内容
-        file_content = await file.read()
-        
-        # 启动后台任务
-        asyncio.create_task(process_image_background(
-            task_id, file_content, processing_type, process_parameters, file.filename or "image"
-        ))
-        
-        return {
-            "success": True,
-            "message": "任务已创建",
-            "task_id": task_id,
-            "estimated_time": 120  # 预估2分钟
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"创建任务失败: {str(e)}"
-        )
-
-async def process_image_background(task_id: str, file_content: bytes, processing_type: str, parameters: dict, filename: str):
-    """
-    后台处理图像任务
-    """
-    try:
-        # 更新任务状态
-        task_progress_manager.update_progress(task_id, {
-            'status': 'running',
-            'progress': 10,
-            'message': '开始处理图像...'
-        })
-        
-        # 在线程池中执行图像处理（因为图像处理是CPU密集型任务）
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            processed_data, processing_time = await loop.run_in_executor(
-                executor,
-                image_processing_service.process_image,
-                file_content,
-                processing_type,
-                parameters,
-                task_id  # 传递task_id用于进度更新
-            )
-        
-        # 保存处理后的图像
-        processed_file_path = save_processed_image(processed_data, filename)
-        
-        # 生成访问URL
-        processed_image_url = get_file_url(processed_file_path)
-        
-        # 更新任务完成状态
-        task_progress_manager.update_progress(task_id, {
-            'status': 'completed',
-            'progress': 100,
-            'message': '处理完成',
-            'result_url': processed_image_url,
-            'completed_at': time.time()
-        })
-        
-    except Exception as e:
-        # 更新任务失败状态
-        task_progress_manager.update_progress(task_id, {
-            'status': 'failed',
-            'progress': 0,
-            'message': '处理失败',
-            'error': str(e)
-        })
-        print(f"❌ [ASYNC TASK] Task {task_id} failed: {str(e)}")
+    
+    return await _spawn_processing_task(
+        processing_type, file, process_parameters,
+        filename=file.filename or "image",
+        estimated_time=120,  # 预估2分钟
+        messages=_PROCESS_TASK_MESSAGES,
+        current_user=current_user,
+        db=db
+    )
 
 @router.post("/text-to-image-async")
 async def text_to_image_async(
@@ -715,117 +825,25 @@ async def text_to_image_async(
     """
     异步文生图端点（支持进度跟踪）
     """
-    import uuid
-    import asyncio
-    from concurrent.futures import ThreadPoolExecutor
+    # 准备文生图参数
+    text_to_image_params = {
+        'prompt': prompt,
+        'negative_prompt': negative_prompt or 'text, watermark, blurry, low quality',
+        'model': model,
+        'width': width,
+        'height': height,
+        'steps': steps,
+        'cfg': cfg
+    }
     
-    try:
-        # 检查积分是否足够
-        required_credits = 10
-        if not check_user_credits(current_user, required_credits):
-            raise HTTPException(
-                status_code=400, 
-                detail=f"积分不足，当前积分：{current_user.credits}，需要积分：{required_credits}。请充值后再试。"
-            )
-            
-        # 扣除积分
-        success = deduct_user_credits(db, current_user, required_credits)
-        if not success:
-            raise HTTPException(
-                status_code=400,
-                detail="积分扣除失败"
-            )
-        
-        # 生成任务ID
-        task_id = str(uuid.uuid4())
-        
-        # 初始化任务进度
-        task_progress_manager.set_progress(task_id, {
-            'status': 'pending',
-            'progress': 0,
-            'message': '任务已创建，准备生成图像...',
-            'result_url': None,
-            'error': None,
-            'created_at': time.time()
-        })
-        
-        # 准备文生图参数
-        text_to_image_params = {
-            'prompt': prompt,
-            'negative_prompt': negative_prompt or 'text, watermark, blurry, low quality',
-            'model': model,
-            'width': width,
-            'height': height,
-            'steps': steps,
-            'cfg': cfg
-        }
-        
-        # 启动后台任务
-        asyncio.create_task(text_to_image_background(task_id, text_to_image_params))
-        
-        return {
-            "success": True,
-            "message": "文生图任务已创建",
-            "task_id": task_id,
-            "estimated_time": 180  # 预估3分钟
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"创建文生图任务失败: {str(e)}"
-        )
-
-async def text_to_image_background(task_id: str, parameters: dict):
-    """
-    后台文生图任务
-    """
-    try:
-        # 更新任务状态
-        task_progress_manager.update_progress(task_id, {
-            'status': 'running',
-            'progress': 10,
-            'message': '开始生成图像...'
-        })
-        
-        # 在线程池中执行文生图处理
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            processed_data, processing_time = await loop.run_in_executor(
-                executor,
-                image_processing_service.process_image,
-                b'',  # 文生图不需要输入图像
-                'text_to_image',
-                parameters,
-                task_id  # 传递task_id用于进度更新
-            )
-        
-        # 保存生成的图像
-        processed_file_path = save_processed_image(processed_data, "generated_image")
-        
-        # 生成访问URL
-        processed_image_url = get_file_url(processed_file_path)
-        
-        # 更新任务完成状态
-        task_progress_manager.update_progress(task_id, {
-            'status': 'completed',
-            'progress': 100,
-            'message': '图像生成完成',
-            'result_url': processed_image_url,
-            'completed_at': time.time()
-        })
-        
-    except Exception as e:
-        # 更新任务失败状态
-        task_progress_manager.update_progress(task_id, {
-            'status': 'failed',
-            'progress': 0,
-            'message': '生成失败',
-            'error': str(e)
-        })
-        print(f"❌ [TEXT-TO-IMAGE TASK] Task {task_id} failed: {str(e)}")
+    return await _spawn_processing_task(
+        'text_to_image', None, text_to_image_params,
+        filename="generated_image",
+        estimated_time=180,  # 预估3分钟
+        messages=_TEXT_TO_IMAGE_TASK_MESSAGES,
+        current_user=current_user,
+        db=db
+    )
 
 @router.post("/upscale")
 async def upscale_image(
@@ -844,6 +862,9 @@ async def upscale_image(
         db=db
     )
 
+# 换脸服务优先返回图片二进制，不支持时仍可返回 base64 JSON
+_FACE_SWAP_ACCEPT_HEADERS = {'Accept': 'image/png, image/jpeg, application/json;q=0.5'}
+
 @router.post("/face-swap", response_model=ImageProcessResponse)
 async def face_swap(
     source_file: UploadFile = File(..., description="源图像文件（提供人脸）"),
@@ -868,24 +889,14 @@ async def face_swap(
     Returns:
         ImageProcessResponse: 处理结果
     """
-    import base64
-    
     try:
-        # 检查积分是否足够
+        # 检查并扣除积分（单条原子UPDATE）
         required_credits = 15  # 换脸功能消耗更多积分
-        if not check_user_credits(current_user, required_credits):
+        if deduct_user_credits_atomic(db, current_user, required_credits) is None:
             raise HTTPException(
                 status_code=400, 
                 detail=f"积分不足，当前积分：{current_user.credits}，需要积分：{required_credits}。请充值后再试。"
             )
-            
-        # 扣除积分
-        success = deduct_user_credits(db, current_user, required_credits)
-        if not success:
-            raise HTTPException(
-                status_code=400,
-                detail="积分扣除失败"
-            )
         
         # 验证文件
         if not validate_image_file(source_file):
@@ -907,20 +918,12 @@ async def face_swap(
         # 调用GPU换脸服务
         start_time = time.time()
         try:
-            # 准备请求数据
-            source_base64 = base64.b64encode(source_content).decode('utf-8')
-            target_base64 = base64.b64encode(target_content).decode('utf-8')
-            
-            # 准备表单数据用于文件上传版本
-            files = {
-                'source_image': ('source.jpg', io.BytesIO(source_content), 'image/jpeg'),
-                'target_image': ('target.jpg', io.BytesIO(target_content), 'image/jpeg')
-            }
-            
-            data = {
-                'source_index': source_index,
-                'target_index': target_index
-            }
+            # 准备表单数据（multipart 直接上传原始字节，无需 base64 编码）
+            form = aiohttp.FormData()
+            form.add_field('source_image', source_content, filename='source.jpg', content_type='image/jpeg')
+            form.add_field('target_image', target_content, filename='target.jpg', content_type='image/jpeg')
+            form.add_field('source_index', str(source_index))
+            form.add_field('target_index', str(target_index))
             
             # 调用GPU换脸API（使用文件上传版本）
             face_swap_url = f"{settings.face_swap_api_url}/swap_faces_file"
@@ -928,44 +931,55 @@ async def face_swap(
             print(f"🔄 调用换脸API: {face_swap_url}")
             print(f"📊 参数: source_index={source_index}, target_index={target_index}")
             
-            response = requests.post(
+            # 复用共享会话的连接池，避免每次请求重新握手
+            session = await get_session()
+            async with session.post(
                 face_swap_url,
-                files=files,
-                data=data,
-                timeout=settings.face_swap_timeout
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"换脸API调用失败，状态码: {response.status_code}, 响应: {response.text}")
-            
-            result = response.json()
+                data=form,
+                headers=_FACE_SWAP_ACCEPT_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=settings.face_swap_timeout)
+            ) as response:
+                if response.status != 200:
+                    raise Exception(f"换脸API调用失败，状态码: {response.status}, 响应: {await response.text()}")
+                
+                # 服务支持直接返回图片时跳过 JSON 解析和 base64 解码
+                if response.content_type.startswith('image/'):
+                    processed_data = await response.read()
+                    result = None
+                else:
+                    result = await response.json(content_type=None)
             
-            if not result.get('success'):
-                raise Exception(result.get('message', '换脸处理失败'))
-            
-            # 获取结果图像的base64数据
-            result_image_base64 = result.get('result_image')
-            if not result_image_base64:
-                raise Exception('换脸API未返回结果图像')
-            
-            # 解码base64图像
-            processed_data = base64.b64decode(result_image_base64)
-            processing_time = result.get('processing_time', time.time() - start_time)
-            
-            print(f"✅ 换脸成功，处理时间: {processing_time:.2f}秒")
-            print(f"📈 检测到源图人脸: {result.get('source_faces_count', 0)}个")
-            print(f"📈 检测到目标人脸: {result.get('target_faces_count', 0)}个")
+            if result is None:
+                processing_time = time.time() - start_time
+                print(f"✅ 换脸成功（二进制响应），处理时间: {processing_time:.2f}秒")
+            else:
+                if not result.get('success'):
+                    raise Exception(result.get('message', '换脸处理失败'))
+                
+                # 获取结果图像的base64数据
+                result_image_base64 = result.get('result_image')
+                if not result_image_base64:
+                    raise Exception('换脸API未返回结果图像')
+                
+                # 解码base64图像
+                processed_data = base64.b64decode(result_image_base64, validate=False)
+                processing_time = result.get('processing_time', time.time() - start_time)
+                
+                print(f"✅ 换脸成功，处理时间: {processing_time:.2f}秒")
+                print(f"📈 检测到源图人脸: {result.get('source_faces_count', 0)}个")
+                print(f"📈 检测到目标人脸: {result.get('target_faces_count', 0)}个")
             
-        except requests.exceptions.Timeout:
+        except asyncio.TimeoutError:
             raise Exception("换脸服务响应超时，请稍后重试")
-        except requests.exceptions.ConnectionError:
+        except aiohttp.ClientConnectionError:
             raise Exception("无法连接到换脸服务，请检查服务状态")
         except Exception as e:
             print(f"❌ 调用换脸API失败: {str(e)}")
             raise Exception(f"换脸处理失败: {str(e)}")
         
         # 保存处理后的图像
-        processed_file_path = save_processed_image(
+        processed_file_path = await run_in_threadpool(
+            save_processed_image,
             processed_data, 
             source_file.filename or "face_swap_result"
         )
@@ -0,0 +1,365 @@
+"""
+ComfyUI 客户端
+
+吉卜力风格、创意放大、文生图三个处理器共用的ComfyUI调用：上传输入图、提交工作流、
+通过WebSocket事件等待执行完成、下载结果图。处理器只负责准备工作流和挑选输出节点
+"""
+
+from typing import Dict, Any, List, Callable, NamedTuple, Optional, Tuple
+import asyncio
+import itertools
+import os
+import random
+import uuid
+import aiohttp
+import orjson
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from urllib.parse import quote
+from app.config import settings
+from app.utils.http_client import get_session
+
+# 解析ComfyUI响应（history、上传/提交结果、WebSocket事件）使用的JSON解析函数，orjson比标准库快数倍
+_json_loads = orjson.loads
+
+def _json_dumps(obj) -> bytes:
+    """序列化提交给ComfyUI的请求体（orjson直接输出UTF-8字节，工作流里混入的numpy数值也能序列化）"""
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+class WorkflowMeta(NamedTuple):
+    """
+    工作流模板的节点索引，随模板一起缓存
+    
+    模板是静态的，按 class_type 归类的节点ID只在加载时计算一次，
+    每个请求填参数时直接定位节点，不再遍历整个工作流
+    """
+    nodes_by_class: Dict[str, Tuple[str, ...]]
+    
+    @classmethod
+    def from_workflow(cls, workflow: Dict) -> 'WorkflowMeta':
+        """一次遍历建立 class_type -> (节点ID, ...) 索引（按工作流中的出现顺序）"""
+        by_class: Dict[str, List[str]] = {}
+        for node_id, node in workflow.items():
+            by_class.setdefault(node.get("class_type"), []).append(node_id)
+        return cls({class_type: tuple(ids) for class_type, ids in by_class.items()})
+    
+    def ids(self, class_type: str) -> Tuple[str, ...]:
+        """指定类型的全部节点ID"""
+        return self.nodes_by_class.get(class_type, ())
+    
+    @property
+    def load_image_ids(self) -> Tuple[str, ...]:
+        return self.ids("LoadImage")
+    
+    @property
+    def save_image_ids(self) -> Tuple[str, ...]:
+        return self.ids("SaveImage")
+    
+    @property
+    def comparer_ids(self) -> Tuple[str, ...]:
+        """对比图节点（如 rgthree 的 Image Comparer），只用于界面预览，提交前可以删掉"""
+        return tuple(
+            node_id for class_type, ids in self.nodes_by_class.items()
+            if class_type and "Comparer" in class_type for node_id in ids
+        )
+
+@lru_cache(maxsize=8)
+def _read_workflow_file(path: str, mtime_ns: int) -> Tuple[bytes, WorkflowMeta]:
+    """读取工作流JSON原文并建立节点索引，按 (路径, 修改时间) 缓存，文件被修改后自动重新读取"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data, WorkflowMeta.from_workflow(_json_loads(data))
+
+def load_workflow_with_meta(path: str) -> Tuple[Dict, WorkflowMeta]:
+    """
+    加载ComfyUI工作流模板及其节点索引
+    
+    缓存的是文件原文，每次调用重新解析得到一份新的dict，调用方可以随意修改。
+    对几KB的工作流，orjson解析比 copy.deepcopy 缓存的dict快4~9倍
+    
+    文件不存在时抛出 FileNotFoundError，格式错误时抛出 json.JSONDecodeError（orjson的异常是它的子类）
+    """
+    # 纳秒精度的修改时间作为缓存键，同一秒内的连续修改也能识别
+    data, meta = _read_workflow_file(path, os.stat(path).st_mtime_ns)
+    return _json_loads(data), meta
+
+def load_workflow(path: str) -> Dict:
+    """加载ComfyUI工作流模板（不需要节点索引时使用），异常同 load_workflow_with_meta"""
+    return load_workflow_with_meta(path)[0]
+
+# 下载结果图的URL模板，查询参数逐个quote，省去每次构造dict再 urlencode
+_VIEW_URL = "http://{}/view?filename={}&subfolder={}&type={}"
+
+def _comfyui_view_url(server_address: str, filename: str, subfolder: str, folder_type: str) -> str:
+    """ComfyUI /view 下载地址"""
+    return _VIEW_URL.format(
+        server_address, quote(filename, safe=''), quote(subfolder, safe=''), quote(folder_type, safe='')
+    )
+
+async def _read_response_body(response: aiohttp.ClientResponse) -> bytearray:
+    """
+    把响应体读入一块按 Content-Length 预分配的 bytearray
+    
+    response.read() 先缓存所有分块再 b"".join，4K结果图下载时内存峰值是图像大小的两倍；
+    这里每个分块到达后直接复制到目标位置随即释放。长度未知或与实际不符时自动扩展/截断
+    """
+    size = response.content_length
+    buffer = bytearray(size if size and 'Content-Encoding' not in response.headers else 0)
+    offset = 0
+    async for chunk in response.content.iter_any():
+        end = offset + len(chunk)
+        buffer[offset:end] = chunk
+        offset = end
+    del buffer[offset:]
+    return buffer
+
+
+# 两次进度更新之间的最短间隔（秒）
+_PROGRESS_MIN_INTERVAL = 0.5
+
+class ComfyUIClient:
+    """
+    ComfyUI 客户端
+    
+    所有请求走 get_session() 的共享 aiohttp 会话。一次完整调用的顺序是：
+        
+        async with comfyui_client.slot:
+            name = await comfyui_client.upload_image(png_bytes, filename)
+            history = await comfyui_client.submit_workflow(workflow, on_progress)
+            data = await comfyui_client.get_image(history['outputs'][node_id]['images'][0])
+    """
+    
+    def __init__(self, server_address: str = None, token: str = None, max_concurrency: int = None):
+        self.server_address = server_address or settings.comfyui_server_address
+        # client_id 和上传文件名只需在进程内唯一：实例创建时取一次随机前缀，之后用计数器区分，
+        # 省去每个请求两次 uuid4()（各一次 getrandom 系统调用）
+        self._instance_id = uuid.uuid4().hex
+        self._counter = itertools.count()
+        # 请求头在这里构造一次，之后每次请求（包括轮询）直接复用，aiohttp只读取不修改
+        token = settings.comfyui_token if token is None else token
+        self._auth_headers = {'Authorization': f'Bearer {token}'} if token else {}
+        self._json_headers = {'Content-Type': 'application/json', **self._auth_headers}
+        # 同时在ComfyUI上执行的任务上限，超出的请求在此排队，避免压垮GPU后端
+        # 每个任务最多同时占用两个连接（WebSocket + 一次HTTP请求），http_client 中的 limit_per_host 据此留足余量
+        self.slot = asyncio.Semaphore(max_concurrency or settings.comfyui_max_concurrency)
+    
+    def _next_id(self) -> str:
+        """实例前缀 + 递增序号"""
+        return f"{self._instance_id}_{next(self._counter)}"
+    
+    def temp_filename(self, prefix: str) -> str:
+        """上传输入图使用的文件名（ComfyUI遇到同名文件会自动改名，以 upload_image 的返回值为准）"""
+        return f"{prefix}_{self._instance_id[:8]}_{next(self._counter)}.png"
+    
+    async def upload_image(self, data: bytes, filename: str) -> str:
+        """
+        上传输入图像到ComfyUI的input目录，返回服务器保存的文件名
+        
+        图像在内存中编码后直接作为multipart上传，不落盘
+        """
+        form = aiohttp.FormData()
+        form.add_field('image', data, filename=filename, content_type='image/png')
+        
+        session = await get_session()
+        async with session.post(
+            f"http://{self.server_address}/upload/image", data=form, headers=self._auth_headers
+        ) as response:
+            if response.status == 200:
+                result = await response.json(loads=_json_loads)
+                return result['name']  # 返回上传后的文件名
+            else:
+                raise Exception(f"图像上传失败: {response.status}")
+    
+    async def queue_prompt(self, workflow: Dict, client_id: str) -> str:
+        """提交工作流到ComfyUI队列，返回prompt_id"""
+        session = await get_session()
+        async with session.post(
+            f"http://{self.server_address}/prompt",
+            data=_json_dumps({"prompt": workflow, "client_id": client_id}),
+            headers=self._json_headers,
+            timeout=aiohttp.ClientTimeout(total=settings.comfyui_timeout)
+        ) as response:
+            status = response.status
+            body = await response.read()
+        
+        if status != 200:
+            raise Exception(f"ComfyUI请求失败，状态码: {status}, 响应: {body.decode('utf-8', 'replace')}")
+        
+        result = _json_loads(body)
+        if 'prompt_id' not in result:
+            raise Exception(f"ComfyUI响应格式错误，未找到prompt_id。响应内容: {result}")
+        return result['prompt_id']
+    
+    async def submit_workflow(self, workflow: Dict,
+                              on_progress: Optional[Callable[[int, int], None]] = None) -> Dict:
+        """
+        提交工作流并等待执行完成，返回该prompt的history
+        
+        先建立WebSocket连接再提交任务，避免漏掉执行事件
+        """
+        # ComfyUI按client_id把事件推给对应的WebSocket，同一id再次连接会顶替旧连接，
+        # 所以并发任务各用一个id，不能整个实例共用
+        client_id = self._next_id()
+        async with self.websocket(client_id) as ws:
+            prompt_id = await self.queue_prompt(workflow, client_id)
+            print(f"ComfyUI 任务ID: {prompt_id}")
+            return await self.wait_for_prompt(ws, prompt_id, settings.comfyui_timeout, on_progress)
+    
+    @asynccontextmanager
+    async def websocket(self, client_id: str):
+        """
+        连接ComfyUI的WebSocket事件流
+        
+        ComfyUI只把执行事件推送给提交prompt时指定的client_id，且不会补发，
+        所以必须在提交prompt之前建立连接
+        
+        服务器可达但拒绝WebSocket升级（如反向代理未放行）时产出None，
+        由 wait_for_prompt 改用轮询
+        """
+        session = await get_session()
+        try:
+            ws = await session.ws_connect(
+                f"ws://{self.server_address}/ws?clientId={client_id}",
+                headers=self._auth_headers,
+                heartbeat=30
+            )
+        except aiohttp.WSServerHandshakeError as e:
+            print(f"ComfyUI WebSocket握手失败(HTTP {e.status})，改为轮询任务状态")
+            yield None
+            return
+        
+        try:
+            yield ws
+        finally:
+            await ws.close()
+    
+    async def _fetch_history(self, prompt_id: str) -> Optional[Dict]:
+        """查询prompt的执行历史，尚未完成时返回None"""
+        session = await get_session()
+        async with session.get(
+            f"http://{self.server_address}/history/{prompt_id}",
+            headers=self._auth_headers,
+            timeout=aiohttp.ClientTimeout(total=30)
+        ) as response:
+            history = await response.json(loads=_json_loads)
+        return history.get(prompt_id)
+    
+    async def _poll_history(self, prompt_id: str, deadline: float, timeout: float) -> Dict:
+        """
+        轮询history直到任务完成（WebSocket中途断开时的兜底）
+        
+        间隔从0.25秒开始指数退避到最多3秒，并加随机抖动，避免多个任务同时断线后齐步轮询
+        """
+        loop = asyncio.get_running_loop()
+        delay = 0.25
+        while loop.time() < deadline:
+            history = await self._fetch_history(prompt_id)
+            if history is not None:
+                return history
+            await asyncio.sleep(min(delay, max(deadline - loop.time(), 0)))
+            delay = min(delay * 1.5, 3.0) + random.uniform(0, 0.2)
+        raise Exception(f"ComfyUI 任务超时 ({timeout}秒)")
+    
+    async def wait_for_prompt(
+        self,
+        ws: Optional[aiohttp.ClientWebSocketResponse],
+        prompt_id: str,
+        timeout: float,
+        on_progress: Optional[Callable[[int, int], None]] = None
+    ) -> Dict:
+        """
+        通过WebSocket事件等待prompt执行完成，返回该prompt的history
+        
+        取代每秒轮询 /history 和 /queue：ComfyUI在执行过程中推送 progress 事件，
+        执行结束时推送 executing(node=None)。输出节点执行完会推送 executed（含结果文件名），
+        据此直接拼出history返回，只有收不到或可能不全时才再查询一次 /history
+        
+        Args:
+            ws: websocket() 建立的连接，为None时直接轮询history
+            prompt_id: 提交prompt后返回的ID
+            timeout: 最长等待秒数
+            on_progress: 进度回调 (当前步数, 总步数)
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        
+        if ws is None:
+            return await self._poll_history(prompt_id, deadline, timeout)
+        
+        # 连接建立后、提交之前已完成的极短任务收不到事件，先查一次history兜底
+        history = await self._fetch_history(prompt_id)
+        if history is not None:
+            return history
+        
+        last_progress = float('-inf')
+        # executed 事件里带着各输出节点的结果，执行结束时直接拼成history，省掉一次 /history 往返
+        outputs: Dict[str, Any] = {}
+        cached = False
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise Exception(f"ComfyUI 任务超时 ({timeout}秒)")
+            try:
+                msg = await asyncio.wait_for(ws.receive(), remaining)
+            except asyncio.TimeoutError:
+                raise Exception(f"ComfyUI 任务超时 ({timeout}秒)")
+            
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                continue  # 采样预览图，忽略
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                # 连接中途断开（ComfyUI重启、代理超时等），任务可能仍在执行，改为轮询history
+                print("ComfyUI WebSocket连接已断开，改为轮询任务状态")
+                return await self._poll_history(prompt_id, deadline, timeout)
+            
+            event = msg.json(loads=_json_loads)
+            data = event.get('data') or {}
+            # 旧版本ComfyUI的progress事件不带prompt_id
+            if data.get('prompt_id', prompt_id) != prompt_id:
+                continue
+            
+            event_type = event.get('type')
+            if event_type == 'progress':
+                # 每个采样步都会推送一次，进度写入Redis（读+写+发布）按时间节流，最后一步总是写入
+                now = loop.time()
+                if on_progress and (data['value'] >= data['max'] or now - last_progress >= _PROGRESS_MIN_INTERVAL):
+                    last_progress = now
+                    on_progress(data['value'], data['max'])
+            elif event_type == 'executed':
+                if data.get('output'):
+                    outputs[data['node']] = data['output']
+            elif event_type == 'execution_cached':
+                # 旧版本ComfyUI命中缓存的节点不推送 executed，结果可能不全，以history为准
+                cached = cached or bool(data.get('nodes'))
+            elif event_type == 'execution_error':
+                raise Exception(f"ComfyUI 执行出错: {data.get('exception_message')}")
+            elif event_type == 'execution_success' or (event_type == 'executing' and data.get('node') is None):
+                break
+        
+        if outputs and not cached:
+            return {'outputs': outputs}
+        
+        history = await self._fetch_history(prompt_id)
+        if history is None:
+            raise Exception(f"ComfyUI 任务已结束但未找到执行历史: {prompt_id}")
+        return history
+    
+    async def get_image(self, image_info: Dict) -> bytearray:
+        """下载history中的一张结果图（image_info 含 filename/subfolder/type）"""
+        session = await get_session()
+        async with session.get(
+            _comfyui_view_url(
+                self.server_address, image_info['filename'], image_info['subfolder'], image_info['type']
+            ),
+            headers=self._auth_headers,
+            timeout=aiohttp.ClientTimeout(total=settings.comfyui_timeout)
+        ) as response:
+            # 文件不存在等错误时直接抛出，不把错误页当成图像去解码
+            response.raise_for_status()
+            return await _read_response_body(response)
+    
+    async def get_images(self, images: List[Dict]) -> List[bytearray]:
+        """并发下载多张结果图，结果与输入顺序一致"""
+        return list(await asyncio.gather(*(self.get_image(image_info) for image_info in images)))
+
+# 进程内共享的ComfyUI客户端
+comfyui_client = ComfyUIClient()
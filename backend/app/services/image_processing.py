@@ -1,15 +1,111 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Tuple, Optional, FrozenSet, Union
 import numpy as np
 from PIL import Image
 import cv2
 import io
-import base64
 import time
-import requests
-import aiohttp
 import asyncio
+import os
+import json
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from app.config import settings
+from app.utils.file_utils import sniff_image_type
+from app.services.comfyui_client import comfyui_client, load_workflow, load_workflow_with_meta, WorkflowMeta
+
+logger = logging.getLogger(__name__)
+
+# CPU密集型图像计算（解码/编码、OpenCV滤镜、缩放）专用的有界线程池
+# OpenCV和PIL在原生代码中会释放GIL，多张图可以在线程中并行跑满多核，
+# 线程数与CPU核数一致即可，避免线程过多互相争抢。
+# 不用进程池：图像要在进程间序列化传递，2000x2000 RGB 仅 pickle 往返就约13ms，是灰度转换本身（约3ms）的4倍
+_CPU_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="image-cpu")
+
+async def run_cpu_bound(func, *args):
+    """在CPU线程池中执行同步函数，不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_CPU_POOL, func, *args)
+
+class _ComfyUIProgress:
+    """
+    ComfyUI任务的进度上报
+    
+    采样过程中按步数写入30%~70%的进度，执行完成后写入80%；批量提交时同一份进度写给批内所有任务。
+    进度写入Redis是同步调用（读+写+发布），这里回调只在事件循环中记下最新一条，
+    由一个后台任务在线程中写入，写入期间到达的更新合并为最新的一条，事件循环不会被Redis往返阻塞。
+    提交结束（无论成败）都要调用 close，确保之后写入的完成/失败状态不会被迟到的进度覆盖
+    """
+    
+    def __init__(self, task_ids: List[Optional[str]], running_message: str, done_message: str):
+        self._task_ids = [task_id for task_id in task_ids if task_id]
+        self._running_message = running_message
+        self._done_message = done_message
+        self._tracked: Optional[List[str]] = None  # 首次写入时在线程中确定，未在Redis中登记的任务跳过
+        self._pending: Optional[Dict[str, Any]] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._closed = False
+    
+    def on_progress(self, value: int, maximum: int):
+        """wait_for_prompt 的进度回调 (当前步数, 总步数)"""
+        logger.debug("ComfyUI 任务进行中... %d/%d", value, maximum)
+        self._submit({
+            "progress": 30 + 40 * value // maximum,
+            "message": f"{self._running_message} ({value}/{maximum})"
+        })
+    
+    async def done(self):
+        """写入完成进度，并等待之前的进度全部写完"""
+        self._submit({"progress": 80, "message": self._done_message})
+        if self._writer is not None:
+            await self._writer
+    
+    async def close(self):
+        """丢弃尚未写入的进度，并等待正在线程中执行的写入结束"""
+        self._closed = True
+        self._pending = None
+        if self._writer is not None:
+            # 写入失败只影响进度展示，不能掩盖提交本身的异常
+            await asyncio.gather(self._writer, return_exceptions=True)
+    
+    def _submit(self, update: Dict[str, Any]):
+        if not self._task_ids or self._closed:
+            return
+        self._pending = update
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._drain())
+    
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while self._pending is not None:
+            update, self._pending = self._pending, None
+            await loop.run_in_executor(None, self._write, update)
+    
+    def _write(self, update: Dict[str, Any]):
+        from app.utils.redis_client import task_progress_manager
+        if self._tracked is None:
+            self._tracked = [task_id for task_id in self._task_ids if task_progress_manager.exists(task_id)]
+        for task_id in self._tracked:
+            task_progress_manager.update_progress(task_id, update)
+
+def _decode_comfyui_output(data: bytearray) -> Image.Image:
+    """
+    解码ComfyUI返回的结果图
+    
+    cv2.imdecode 通过 np.frombuffer 直接读取下载缓冲区，不再复制一份到 BytesIO；
+    OpenCV不支持的格式或非8位图像回退到PIL
+    """
+    arr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if arr is not None and arr.dtype == np.uint8:
+        if arr.ndim == 3:
+            arr = cv2.cvtColor(arr, cv2.COLOR_BGRA2RGBA if arr.shape[2] == 4 else cv2.COLOR_BGR2RGB)
+        return _array_to_image(arr)
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
 
 class ImageProcessor(ABC):
     """
@@ -20,10 +116,13 @@ class ImageProcessor(ABC):
     """
     
     @abstractmethod
-    def process(self, image: Image.Image, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
+    async def process(self, image: Image.Image, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
         """
         处理图像的抽象方法
         
+        该方法在事件循环中被 await，不能有阻塞调用：网络请求使用 get_session() 的共享
+        aiohttp 会话，等待用 asyncio.sleep 或 WebSocket 事件，CPU密集计算使用 run_cpu_bound
+        
         Args:
             image: PIL图像对象
             parameters: 处理参数字典
@@ -49,20 +148,94 @@ class ImageProcessor(ABC):
         子类可以重写此方法来添加特定验证
         """
         return True
+    
+    def accepted_modes(self) -> FrozenSet[str]:
+        """
+        process 能直接处理的输入图像模式
+        
+        包含 'L' 时灰度输入按单通道解码，不再扩展为3倍大小的RGB；其余输入一律解码为RGB
+        """
+        return frozenset({'RGB'})
+    
+    def raw_output_format(self) -> Optional[str]:
+        """
+        process_raw 返回的编码格式，None表示不支持
+        
+        与输出格式相同时，process_image 改调 process_raw，后端返回的数据原样作为结果，
+        省去一次解码和一次编码
+        """
+        return None
+    
+    async def process_raw(self, image: Image.Image, parameters: Dict[str, Any] = None,
+                          task_id: str = None) -> Union[bytearray, Image.Image]:
+        """
+        返回后端生成的编码数据（格式为 raw_output_format()），不做解码
+        
+        走降级方案时没有编码数据，返回PIL图像，由调用方编码
+        """
+        return await self.process(image, parameters, task_id)
+
+def _image_to_array(image: Image.Image) -> np.ndarray:
+    """
+    取得PIL图像的像素数组（只读）
+    
+    PIL通过数组接口导出一份像素快照，这是唯一的一次复制；
+    实测 np.frombuffer(image.tobytes()) 并不比它快，np.array 还会再复制一次。
+    返回的数组不可写，需要原地修改的调用方应自行 copy
+    """
+    return np.asarray(image)
+
+# 三维数组通道数对应的PIL模式
+_ARRAY_MODES = {3: 'RGB', 4: 'RGBA'}
+
+def _array_to_image(arr: np.ndarray) -> Image.Image:
+    """
+    把 uint8 的灰度/RGB/RGBA 数组包装成PIL图像
+    
+    连续内存直接用 frombuffer 共享数组缓冲区，不再复制一遍像素
+    """
+    if arr.flags['C_CONTIGUOUS']:
+        mode = 'L' if arr.ndim == 2 else _ARRAY_MODES.get(arr.shape[2])
+        if mode:
+            return Image.frombuffer(mode, (arr.shape[1], arr.shape[0]), arr, 'raw', mode, 0, 1)
+    return Image.fromarray(arr)
+
+# PIL自身的解压炸弹保护与上传像素上限保持一致
+Image.MAX_IMAGE_PIXELS = settings.max_image_pixels
+
+# PNG的zlib压缩级别（0-9）：结果图和上传给ComfyUI的中间图都是临时数据，
+# 级别1比默认的6快3-5倍，文件只大10-20%
+PNG_COMPRESSION_LEVEL = 1
+
+# JPEG输出质量
+JPEG_QUALITY = 90
+
+# WebP单边最大像素数
+_WEBP_MAX_DIMENSION = 16383
+
+# 降级放大时使用Lanczos插值的最大输入像素数，更大的图改用双三次插值
+_LANCZOS_MAX_PIXELS = 512 * 512
+
+# OpenCV 是否带可用的 OpenCL 设备（决定降级滤镜是否走 UMat）
+_USE_OPENCL = cv2.ocl.haveOpenCL()
 
 class GrayscaleProcessor(ImageProcessor):
     """灰度转换处理器"""
     
-    def process(self, image: Image.Image, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
+    async def process(self, image: Image.Image, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
         """将图像转换为灰度"""
-        # 转换为OpenCV格式
-        cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        
-        # 转换为灰度
-        gray_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
-        
-        # 转换回PIL格式
-        return Image.fromarray(gray_image)
+        return await run_cpu_bound(self._to_grayscale, image)
+    
+    def _to_grayscale(self, image: Image.Image) -> Image.Image:
+        """灰度转换的同步实现（在线程中执行）"""
+        if image.mode == 'L':
+            return image
+        # PIL在自身缓冲区上按BT.601权重转换，无需导出数组：
+        # 2000x2000 图像约 4ms，而仅导出数组就要约 18ms，再交给 cv2.cvtColor 反而更慢
+        return image.convert("L")
+    
+    def accepted_modes(self) -> FrozenSet[str]:
+        return frozenset({'RGB', 'L'})
     
     def get_name(self) -> str:
         return "grayscale"
@@ -73,129 +246,82 @@ class GrayscaleProcessor(ImageProcessor):
 class GhibliStyleProcessor(ImageProcessor):
     """吉卜力风格处理器 - 使用ComfyUI和专门的ghibli.json工作流"""
     
-    def process(self, image: Image.Image, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
+    # 降级滤镜的对比度/亮度查找表，等价于 convertScaleAbs(alpha=1.2, beta=10)
+    _CONTRAST_LUT = np.clip(np.rint(np.arange(256) * 1.2 + 10), 0, 255).astype(np.uint8)
+    # 降级滤镜的双边滤波参数 (邻域直径, 颜色sigma, 空间sigma)
+    _BILATERAL_PARAMS = (15, 80, 80)
+    # 半分辨率上做双边滤波时的参数（邻域减半，等效半径不变）
+    _BILATERAL_HALF_RES_PARAMS = (9, 80, 80)
+    # 短边不小于该值时才降采样滤波，小图直接全分辨率处理
+    _BILATERAL_DOWNSAMPLE_MIN_SIDE = 256
+    
+    async def process(self, image: Image.Image, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
         """
         使用ComfyUI和ghibli.json工作流将图像转换为吉卜力风格
         """
+        result = await self.process_raw(image, parameters, task_id)
+        if isinstance(result, Image.Image):
+            return result
+        # 将图像数据转换为 PIL Image
+        return await run_cpu_bound(_decode_comfyui_output, result)
+    
+    async def process_raw(self, image: Image.Image, parameters: Dict[str, Any] = None,
+                          task_id: str = None) -> Union[bytearray, Image.Image]:
+        """返回ComfyUI输出的PNG原始数据，调用失败时返回降级滤镜处理后的图像"""
         try:
             # 调用 ComfyUI API
-            image_data = self._call_comfyui_ghibli_api(image, task_id)
-            
-            # 将图像数据转换为 PIL Image
-            return Image.open(io.BytesIO(image_data))
-            
+            return await self._call_comfyui_ghibli_api(image, task_id)
         except Exception as e:
             print(f"ComfyUI 吉卜力风格API调用失败: {e}")
             # 降级方案：使用简单的滤镜效果
-            return self._fallback_ghibli_style(image)
+            return await run_cpu_bound(self._fallback_ghibli_style, image)
     
-    def _call_comfyui_ghibli_api(self, image: Image.Image, task_id: str = None) -> bytes:
+    async def _call_comfyui_ghibli_api(self, image: Image.Image, task_id: str = None) -> bytearray:
         """
         调用 ComfyUI API 进行吉卜力风格转换
-        """
-        import json
-        import uuid
-        import tempfile
-        import os
-        from urllib.parse import urlencode
-        
-        server_address = settings.comfyui_server_address
-        client_id = str(uuid.uuid4())
-        
-        # 1. 保存输入图像到临时文件
-        temp_image_path = self._save_temp_image(image)
         
-        try:
-            # 2. 上传图像到ComfyUI服务器
-            uploaded_filename = self._upload_image_to_comfyui(temp_image_path, server_address)
+        上传、提交、等待、下载全程走共享的 aiohttp 会话，只有PNG编码放到CPU线程池
+        """
+        async with comfyui_client.slot:
+            # 1. 编码并上传图像到ComfyUI服务器（内存中编码，不落盘）
+            uploaded_filename = await comfyui_client.upload_image(
+                await run_cpu_bound(_encode_png, image), comfyui_client.temp_filename("ghibli_input")
+            )
             
-            # 3. 加载吉卜力工作流模板
+            # 2. 加载吉卜力工作流模板
             workflow = self._load_ghibli_workflow_template()
             if not workflow:
                 raise Exception("无法加载 ComfyUI 吉卜力工作流模板")
             
-            # 4. 更新工作流参数（使用上传后的文件名）
+            # 3. 更新工作流参数（使用上传后的文件名）
             workflow = self._update_ghibli_workflow_with_uploaded_image(workflow, uploaded_filename)
             
-            # 5. 提交到队列
-            prompt_data = {"prompt": workflow, "client_id": client_id}
-            data = json.dumps(prompt_data).encode('utf-8')
-            
-            # 准备请求头，如果有TOKEN则添加认证
-            headers = {'Content-Type': 'application/json'}
-            if settings.comfyui_token:
-                headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-            
-            response = requests.post(
-                f"http://{server_address}/prompt", 
-                data=data,
-                headers=headers,
-                timeout=settings.comfyui_timeout
+            # 4. 提交并等待完成
+            print("正在等待 ComfyUI 吉卜力风格转换...")
+            progress = _ComfyUIProgress(
+                [task_id], "正在转换为吉卜力风格...", "吉卜力风格转换完成，正在下载..."
             )
-            result = response.json()
-            prompt_id = result['prompt_id']
-            
-            print(f"ComfyUI 吉卜力风格任务ID: {prompt_id}")
-            
-            # 6. 等待完成
-            history = self._wait_for_completion(server_address, prompt_id, task_id)
-            
-            # 7. 获取生成的图像（优先获取节点136的最终结果）
-            for node_id in ['136', '8']:  # 先尝试节点136，再尝试节点8
-                if node_id in history['outputs']:
-                    node_output = history['outputs'][node_id]
-                    if 'images' in node_output:
-                        for image_info in node_output['images']:
-                            print(f"找到吉卜力风格图像(节点{node_id}): {image_info}")
-                            image_data = self._get_image(
-                                server_address, image_info['filename'], 
-                                image_info['subfolder'], image_info['type']
-                            )
-                            return image_data
-            
-            raise Exception("未能从 ComfyUI 获取吉卜力风格图像")
+            try:
+                history = await comfyui_client.submit_workflow(workflow, progress.on_progress)
+                await progress.done()
+            finally:
+                await progress.close()
+            print("✅ 吉卜力风格转换完成！")
             
-        finally:
-            # 清理临时文件
-            if os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-    
-    def _upload_image_to_comfyui(self, image_path: str, server_address: str) -> str:
-        """上传图像到ComfyUI服务器"""
-        # 准备认证头
-        headers = {}
-        if settings.comfyui_token:
-            headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-        
-        with open(image_path, 'rb') as f:
-            files = {'image': f}
-            response = requests.post(f"http://{server_address}/upload/image", files=files, headers=headers)
-            if response.status_code == 200:
-                result = response.json()
-                return result['name']  # 返回上传后的文件名
-            else:
-                raise Exception(f"图像上传失败: {response.status_code}")
+            # 5. 获取生成的图像
+            return await self._get_output_image(history)
     
-    def _save_temp_image(self, image: Image.Image) -> str:
-        """保存图像到指定目录"""
-        import tempfile
-        import os
-        import uuid
-        
-        # 生成唯一文件名
-        filename = f"ghibli_input_{uuid.uuid4().hex[:8]}.png"
-        
-        # 使用配置的目录
-        input_dir = settings.comfyui_input_dir
-        
-        # 确保目录存在
-        os.makedirs(input_dir, exist_ok=True)
-        
-        # 保存文件
-        file_path = os.path.join(input_dir, filename)
-        image.save(file_path, format='PNG')
+    async def _get_output_image(self, history: Dict) -> bytearray:
+        """从执行历史中获取吉卜力风格图像（优先获取节点136的最终结果）"""
+        for node_id in ['136', '8']:  # 先尝试节点136，再尝试节点8
+            if node_id in history['outputs']:
+                node_output = history['outputs'][node_id]
+                if 'images' in node_output:
+                    for image_info in node_output['images']:
+                        print(f"找到吉卜力风格图像(节点{node_id}): {image_info}")
+                        return await comfyui_client.get_image(image_info)
         
-        return file_path
+        raise Exception("未能从 ComfyUI 获取吉卜力风格图像")
     
     def _load_ghibli_workflow_template(self) -> Dict:
         """加载吉卜力工作流模板"""
@@ -205,9 +331,7 @@ class GhibliStyleProcessor(ImageProcessor):
         json_file_path = os.path.join(os.getcwd(), "workflow/ghibli.json")
         
         try:
-            with open(json_file_path, 'r', encoding='utf-8') as f:
-                workflow = json.load(f)
-            return workflow
+            return load_workflow(json_file_path)
         except FileNotFoundError:
             print(f"找不到吉卜力工作流文件: {json_file_path}")
             return None
@@ -225,18 +349,18 @@ class GhibliStyleProcessor(ImageProcessor):
             if "inputs" not in workflow["192"]:
                 workflow["192"]["inputs"] = {}
             workflow["192"]["inputs"]["image"] = uploaded_filename
-            print(f"更新LoadImage节点192的图像路径为: {uploaded_filename}")
+            logger.debug("更新LoadImage节点192的图像路径为: %s", uploaded_filename)
         else:
-            print("警告: 在吉卜力工作流中未找到LoadImage节点192")
+            logger.warning("在吉卜力工作流中未找到LoadImage节点192")
         
         # 删除对比图节点213和212，只保留最终结果
         if "213" in workflow:
             del workflow["213"]
-            print("删除对比图保存节点213")
+            logger.debug("删除对比图保存节点213")
         
         if "212" in workflow:
             del workflow["212"]
-            print("删除图像拼接节点212")
+            logger.debug("删除图像拼接节点212")
         
         # 设置输出文件名前缀
         if "136" in workflow:
@@ -244,88 +368,54 @@ class GhibliStyleProcessor(ImageProcessor):
         
         return workflow
     
-    def _wait_for_completion(self, server_address: str, prompt_id: str, task_id: str = None) -> Dict:
-        """等待图像生成完成"""
-        print("正在等待 ComfyUI 吉卜力风格转换...")
-        max_wait_time = settings.comfyui_timeout
-        start_time = time.time()
-        
-        # 导入task_progress_manager（需要在循环外访问）
-        from app.utils.redis_client import task_progress_manager
-        
-        count = 0
-        while time.time() - start_time < max_wait_time:
-            try:
-                # 准备认证头
-                headers = {}
-                if settings.comfyui_token:
-                    headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-                
-                # 查询历史状态
-                response = requests.get(f"http://{server_address}/history/{prompt_id}", headers=headers)
-                history = response.json()
-                
-                if prompt_id in history:
-                    # 任务完成
-                    if task_id and task_progress_manager.exists(task_id):
-                        task_progress_manager.update_progress(task_id, {
-                            "progress": 80,
-                            "message": "吉卜力风格转换完成，正在下载..."
-                        })
-                    print("✅ 吉卜力风格转换完成！")
-                    return history[prompt_id]
-                
-                count += 1
-                # 更新进度
-                if task_id and task_progress_manager.exists(task_id):
-                    progress = min(30 + (count * 2), 70)
-                    task_progress_manager.update_progress(task_id, {
-                        "progress": progress,
-                        "message": f"正在转换为吉卜力风格... ({count}秒)"
-                    })
-                
-                if count % 5 == 0:  # 每5秒打印一次状态
-                    print(f"⏳ 等待中... ({count}秒)")
-                
-                time.sleep(1)
-                
-            except Exception as e:
-                print(f"检查任务状态时出错: {e}")
-                time.sleep(2)
-        
-        raise Exception(f"ComfyUI 吉卜力风格转换任务超时 ({max_wait_time}秒)")
-    
-    def _get_image(self, server_address: str, filename: str, subfolder: str, folder_type: str) -> bytes:
-        """从服务器获取生成的图像"""
-        from urllib.parse import urlencode
-        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urlencode(data)
-        
-        # 准备认证头
-        headers = {}
-        if settings.comfyui_token:
-            headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-        
-        response = requests.get(f"http://{server_address}/view?{url_values}", headers=headers)
-        return response.content
-    
     def _fallback_ghibli_style(self, image: Image.Image) -> Image.Image:
         """
         降级方案：使用简单的滤镜效果模拟吉卜力风格
         """
-        cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+        # 查表和双边滤波都与通道顺序无关，直接在RGB数据上处理，不做RGB/BGR转换
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        cv_image = _image_to_array(image)
+        height, width = cv_image.shape[:2]
+        
+        # 有OpenCL设备时走UMat，让双边滤波在GPU/iGPU上执行；
+        # 没有时UMat只会多一次拷贝，直接用普通数组
+        if _USE_OPENCL:
+            cv_image = cv2.UMat(cv_image)
         
         # 应用一些基本的图像处理来模拟艺术效果
-        # 增强对比度
-        alpha = 1.2  # 对比度
-        beta = 10    # 亮度
-        enhanced = cv2.convertScaleAbs(cv_image, alpha=alpha, beta=beta)
+        # 增强对比度（查表代替逐像素乘加）
+        enhanced = cv2.LUT(cv_image, self._CONTRAST_LUT)
         
-        # 应用双边滤波来平滑图像
-        smooth = cv2.bilateralFilter(enhanced, 15, 80, 80)
+        # 边缘保持平滑
+        smooth = self._smooth(enhanced, (width, height))
+        if _USE_OPENCL:
+            smooth = smooth.get()
         
         # 转换回PIL格式
-        return Image.fromarray(cv2.cvtColor(smooth, cv2.COLOR_BGR2RGB))
+        return _array_to_image(smooth)
+    
+    def _smooth(self, image, size: Tuple[int, int]):
+        """
+        边缘保持平滑（cv2.bilateralFilter）
+        
+        较大的图先降采样一半再滤波、最后线性插值放大，
+        滤波计算量降为约1/4；风格化效果以低频为主，画质差异不明显
+        
+        Args:
+            image: 待平滑的数组（或UMat）
+            size: 原图尺寸 (宽, 高)
+        """
+        if min(size) < self._BILATERAL_DOWNSAMPLE_MIN_SIDE:
+            return cv2.bilateralFilter(image, *self._BILATERAL_PARAMS)
+        
+        small = cv2.resize(image, (size[0] // 2, size[1] // 2), interpolation=cv2.INTER_AREA)
+        small = cv2.bilateralFilter(small, *self._BILATERAL_HALF_RES_PARAMS)
+        return cv2.resize(small, size, interpolation=cv2.INTER_LINEAR)
+    
+    def raw_output_format(self) -> Optional[str]:
+        """ComfyUI的SaveImage节点输出PNG"""
+        return 'png'
     
     def get_name(self) -> str:
         return "ghibli_style"
@@ -340,7 +430,10 @@ class CreativeUpscaleProcessor(ImageProcessor):
     使用ComfyUI进行图片的创意放大和修复，参数固定，只需要输入图片
     """
     
-    def process(self, image: Image.Image, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
+    # 提交前添加的SaveImage节点，放大结果从这里取
+    _OUTPUT_NODE_ID = "200"
+    
+    async def process(self, image: Image.Image, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
         """
         使用 ComfyUI 进行创意放大修复
         
@@ -352,156 +445,99 @@ class CreativeUpscaleProcessor(ImageProcessor):
         Returns:
             处理后的图像
         """
+        result = await self.process_raw(image, parameters, task_id)
+        if isinstance(result, Image.Image):
+            return result
+        # 将图像数据转换为 PIL Image
+        return await run_cpu_bound(_decode_comfyui_output, result)
+    
+    async def process_raw(self, image: Image.Image, parameters: Dict[str, Any] = None,
+                          task_id: str = None) -> Union[bytearray, Image.Image]:
+        """返回ComfyUI输出的PNG原始数据，调用失败时返回简单放大后的图像"""
         try:
             # 调用 ComfyUI API
-            image_data = self._call_comfyui_upscale_api(image, task_id)
-            
-            # 将图像数据转换为 PIL Image
-            return Image.open(io.BytesIO(image_data))
-            
+            return await self._call_comfyui_upscale_api(image, task_id)
         except Exception as e:
             print(f"ComfyUI 创意放大API调用失败: {e}")
             # 降级方案：使用简单的放大
-            return self._fallback_upscale(image)
+            return await run_cpu_bound(self._fallback_upscale, image)
     
-    def _call_comfyui_upscale_api(self, image: Image.Image, task_id: str = None) -> bytes:
+    async def _call_comfyui_upscale_api(self, image: Image.Image, task_id: str = None) -> bytearray:
         """
         调用 ComfyUI API 进行创意放大
-        """
-        import json
-        import uuid
-        import tempfile
-        import os
-        from urllib.parse import urlencode
-        
-        server_address = settings.comfyui_server_address
-        client_id = str(uuid.uuid4())
         
-        # 1. 保存输入图像到临时文件
-        temp_image_path = self._save_temp_image(image)
-        
-        try:
-            # 2. 上传图像到ComfyUI服务器
-            uploaded_filename = self._upload_image_to_comfyui(temp_image_path, server_address)
+        上传、提交、等待、下载全程走共享的 aiohttp 会话，只有PNG编码放到CPU线程池
+        """
+        async with comfyui_client.slot:
+            # 1. 编码并上传图像到ComfyUI服务器（内存中编码，不落盘）
+            uploaded_filename = await comfyui_client.upload_image(
+                await run_cpu_bound(_encode_png, image), comfyui_client.temp_filename("input")
+            )
             
-            # 3. 加载放大工作流模板
-            workflow = self._load_upscale_workflow_template()
-            if not workflow:
+            # 2. 加载放大工作流模板
+            template = self._load_upscale_workflow_template()
+            if not template:
                 raise Exception("无法加载 ComfyUI 放大工作流模板")
             
-            # 4. 更新工作流参数（使用上传后的文件名）
-            workflow = self._update_upscale_workflow_with_uploaded_image(workflow, uploaded_filename)
-            
-            # 5. 提交到队列
-            prompt_data = {"prompt": workflow, "client_id": client_id}
-            data = json.dumps(prompt_data).encode('utf-8')
-            
-            # 准备请求头，如果有TOKEN则添加认证
-            headers = {'Content-Type': 'application/json'}
-            if settings.comfyui_token:
-                headers['Authorization'] = f'Bearer {settings.comfyui_token}'
+            # 3. 更新工作流参数（使用上传后的文件名）
+            workflow = self._update_upscale_workflow_with_uploaded_image(*template, uploaded_filename)
             
-            response = requests.post(
-                f"http://{server_address}/prompt", 
-                data=data,
-                headers=headers,
-                timeout=settings.comfyui_timeout
+            # 4. 提交并等待完成
+            print("正在等待 ComfyUI 放大处理...")
+            progress = _ComfyUIProgress(
+                [task_id], "正在放大处理...", "放大处理完成，正在下载..."
             )
+            try:
+                history = await comfyui_client.submit_workflow(workflow, progress.on_progress)
+                await progress.done()
+            finally:
+                await progress.close()
+            print("✅ 放大处理完成！")
             
-            print(f"ComfyUI放大响应状态码: {response.status_code}")
-            print(f"ComfyUI放大响应内容: {response.text}")
-            
-            if response.status_code != 200:
-                raise Exception(f"ComfyUI放大请求失败，状态码: {response.status_code}, 响应: {response.text}")
-            
-            result = response.json()
-            
-            if 'prompt_id' not in result:
-                raise Exception(f"ComfyUI放大响应格式错误，未找到prompt_id。响应内容: {result}")
-                
-            prompt_id = result['prompt_id']
-            
-            print(f"ComfyUI 放大任务ID: {prompt_id}")
-            
-            # 6. 等待完成
-            history = self._wait_for_completion(server_address, prompt_id, task_id)
-            
-            # 7. 获取生成的图像（优先获取节点200的SaveImage输出）
-            print(f"历史输出节点: {list(history['outputs'].keys())}")
-            
-            # 优先查找我们添加的SaveImage节点200
-            if '200' in history['outputs']:
-                node_output = history['outputs']['200']
-                if 'images' in node_output:
-                    for image_info in node_output['images']:
-                        print(f"找到放大后的图像(节点200): {image_info}")
-                        image_data = self._get_image(
-                            server_address, image_info['filename'], 
-                            image_info['subfolder'], image_info['type']
-                        )
-                        return image_data
-            
-            # 备用方案：查找其他输出节点，但跳过LoadImage节点101
-            for node_id in history['outputs']:
-                if node_id == '101':  # 跳过原图输入节点
-                    continue
-                    
-                node_output = history['outputs'][node_id]
-                if 'images' in node_output:
-                    for image_info in node_output['images']:
-                        print(f"找到备用图像(节点{node_id}): {image_info}")
-                        image_data = self._get_image(
-                            server_address, image_info['filename'], 
-                            image_info['subfolder'], image_info['type']
-                        )
-                        return image_data
-            
-            raise Exception("未能从 ComfyUI 获取放大后的图像")
-            
-        finally:
-            # 清理临时文件
-            if os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-    
-    def _upload_image_to_comfyui(self, image_path: str, server_address: str) -> str:
-        """上传图像到ComfyUI服务器"""
-        # 准备认证头
-        headers = {}
-        if settings.comfyui_token:
-            headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-        
-        with open(image_path, 'rb') as f:
-            files = {'image': f}
-            response = requests.post(f"http://{server_address}/upload/image", files=files, headers=headers)
-            if response.status_code == 200:
-                result = response.json()
-                return result['name']  # 返回上传后的文件名
-            else:
-                raise Exception(f"图像上传失败: {response.status_code}")
+            # 5. 获取生成的图像
+            return await self._get_output_image(history)
+    
+    async def _get_output_image(self, history: Dict) -> bytearray:
+        """
+        从执行历史中获取放大后的图像
+        
+        结果节点是提交前添加的SaveImage节点200，直接按ID取；
+        找不到时退回到第一个有图像输出、且不是原图LoadImage节点101的节点
+        """
+        outputs = history['outputs']
+        node_output = outputs.get(self._OUTPUT_NODE_ID) or next(
+            (output for node_id, output in outputs.items() if node_id != '101' and output.get('images')), None
+        )
+        if not node_output or not node_output.get('images'):
+            raise Exception(f"未能从 ComfyUI 获取放大后的图像，输出节点: {list(outputs)}")
+        
+        image_info = node_output['images'][0]
+        logger.debug("找到放大后的图像: %s", image_info)
+        return await comfyui_client.get_image(image_info)
     
-    def _update_upscale_workflow_with_uploaded_image(self, workflow: Dict, uploaded_filename: str) -> Dict:
-        """使用上传后的文件名更新放大工作流"""
+    def _update_upscale_workflow_with_uploaded_image(self, workflow: Dict, meta: WorkflowMeta,
+                                                     uploaded_filename: str) -> Dict:
+        """使用上传后的文件名更新放大工作流（节点按模板加载时建立的索引直接定位）"""
         if not workflow:
             return None
         
         # 根据upscale_0801.json，LoadImage节点是101
-        if "101" in workflow:
-            if "inputs" not in workflow["101"]:
-                workflow["101"]["inputs"] = {}
-            workflow["101"]["inputs"]["image"] = uploaded_filename
-            print(f"更新LoadImage节点101的图像路径为: {uploaded_filename}")
+        if meta.load_image_ids:
+            node_id = meta.load_image_ids[0]
+            workflow[node_id].setdefault("inputs", {})["image"] = uploaded_filename
+            logger.debug("更新LoadImage节点%s的图像路径为: %s", node_id, uploaded_filename)
         else:
-            print("警告: 在放大工作流中未找到LoadImage节点101")
+            logger.warning("在放大工作流中未找到LoadImage节点")
         
-        # 删除对比图节点160，只保留最终结果
-        if "160" in workflow:
-            del workflow["160"]
-            print("删除对比图保存节点160")
+        # 删除对比图节点（upscale_0801.json中是160），只保留最终结果
+        for node_id in meta.comparer_ids:
+            del workflow[node_id]
+            logger.debug("删除对比图节点%s", node_id)
         
         # 添加一个SaveImage节点来保存放大后的结果
         if "161" in workflow:
             # 修改节点161为SaveImage节点，连接到最终处理结果
-            workflow["200"] = {
+            workflow[self._OUTPUT_NODE_ID] = {
                 "inputs": {
                     "images": ["161", 0],  # 连接到FilmGrain节点的输出
                     "filename_prefix": f"upscaled_{uploaded_filename.split('.')[0]}"
@@ -511,42 +547,19 @@ class CreativeUpscaleProcessor(ImageProcessor):
                     "title": "Save Upscaled Image"
                 }
             }
-            print("添加SaveImage节点200保存放大结果")
+            logger.debug("添加SaveImage节点200保存放大结果")
         
         return workflow
     
-    def _save_temp_image(self, image: Image.Image) -> str:
-        """保存图像到指定目录"""
-        import tempfile
-        import os
-        import uuid
-        
-        # 生成唯一文件名
-        filename = f"input_{uuid.uuid4().hex[:8]}.png"
-        
-        # 使用配置的目录
-        input_dir = settings.comfyui_input_dir
-        
-        # 确保目录存在
-        os.makedirs(input_dir, exist_ok=True)
-        
-        # 保存文件
-        file_path = os.path.join(input_dir, filename)
-        image.save(file_path, format='PNG')
-        
-        return file_path
-    
-    def _load_upscale_workflow_template(self) -> Dict:
-        """加载放大工作流模板"""
+    def _load_upscale_workflow_template(self) -> Optional[Tuple[Dict, WorkflowMeta]]:
+        """加载放大工作流模板及其节点索引"""
         import json
         import os
         
         json_file_path = os.path.join(os.getcwd(), "workflow/upscale_0801.json")
         
         try:
-            with open(json_file_path, 'r', encoding='utf-8') as f:
-                workflow = json.load(f)
-            return workflow
+            return load_workflow_with_meta(json_file_path)
         except FileNotFoundError:
             print(f"找不到放大工作流文件: {json_file_path}")
             return None
@@ -605,81 +618,27 @@ class CreativeUpscaleProcessor(ImageProcessor):
             }
         }
     
-    def _wait_for_completion(self, server_address: str, prompt_id: str, task_id: str = None) -> Dict:
-        """等待图像生成完成"""
-        print("正在等待 ComfyUI 放大处理...")
-        max_wait_time = settings.comfyui_timeout
-        start_time = time.time()
-        
-        # 导入task_progress_manager（需要在循环外访问）
-        from app.utils.redis_client import task_progress_manager
-        
-        count = 0
-        while time.time() - start_time < max_wait_time:
-            try:
-                # 准备认证头
-                headers = {}
-                if settings.comfyui_token:
-                    headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-                
-                # 查询历史状态
-                response = requests.get(f"http://{server_address}/history/{prompt_id}", headers=headers)
-                history = response.json()
-                
-                if prompt_id in history:
-                    # 任务完成
-                    if task_id and task_progress_manager.exists(task_id):
-                        task_progress_manager.update_progress(task_id, {
-                            "progress": 80,
-                            "message": "放大处理完成，正在下载..."
-                        })
-                    print("✅ 放大处理完成！")
-                    return history[prompt_id]
-                
-                count += 1
-                # 更新进度
-                if task_id and task_progress_manager.exists(task_id):
-                    progress = min(30 + (count * 2), 70)
-                    task_progress_manager.update_progress(task_id, {
-                        "progress": progress,
-                        "message": f"正在放大处理... ({count}秒)"
-                    })
-                
-                if count % 5 == 0:  # 每5秒打印一次状态
-                    print(f"⏳ 等待中... ({count}秒)")
-                
-                time.sleep(1)
-                
-            except Exception as e:
-                print(f"检查任务状态时出错: {e}")
-                time.sleep(2)
-        
-        raise Exception(f"ComfyUI 放大任务超时 ({max_wait_time}秒)")
-    
-    def _get_image(self, server_address: str, filename: str, subfolder: str, folder_type: str) -> bytes:
-        """从服务器获取生成的图像"""
-        from urllib.parse import urlencode
-        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urlencode(data)
-        
-        # 准备认证头
-        headers = {}
-        if settings.comfyui_token:
-            headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-        
-        response = requests.get(f"http://{server_address}/view?{url_values}", headers=headers)
-        return response.content
-    
     def _fallback_upscale(self, image: Image.Image) -> Image.Image:
         """
         降级方案：简单的4倍放大
         """
+        # 调色板等模式的数组是索引值，不能直接插值，先转为RGB
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+        
         width, height = image.size
         new_size = (width * 4, height * 4)
         
-        # 使用双三次插值进行放大
-        upscaled = image.resize(new_size, Image.LANCZOS)
-        return upscaled
+        # 按输入大小选插值核：小图用INTER_LANCZOS4保留更多细节（512x512约60ms）；
+        # 更大的图用双三次插值，OpenCV的INTER_CUBIC有SIMD实现，比INTER_LANCZOS4快十倍以上，
+        # 降级路径下画质差异可以接受
+        interpolation = cv2.INTER_LANCZOS4 if width * height <= _LANCZOS_MAX_PIXELS else cv2.INTER_CUBIC
+        upscaled = cv2.resize(_image_to_array(image), new_size, interpolation=interpolation)
+        return _array_to_image(upscaled)
+    
+    def raw_output_format(self) -> Optional[str]:
+        """ComfyUI的SaveImage节点输出PNG"""
+        return 'png'
     
     def get_name(self) -> str:
         return "creative_upscale"
@@ -698,7 +657,15 @@ class TextToImageProcessor(ImageProcessor):
     这个处理器不需要输入图像，而是基于文字描述生成图像
     """
     
-    def process(self, image: Image.Image = None, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
+    # 占位图字体，首次使用时加载一次，之后复用（避免每次都读取并解析TTF文件）
+    _FONT = None
+    
+    def __init__(self):
+        # 攒批中的请求：生成参数 -> [(等待结果的future, task_id), ...]
+        self._pending: Dict[Tuple, List[Tuple[asyncio.Future, Optional[str]]]] = {}
+        self._batch_tasks = set()  # 持有执行中批次的引用，避免任务被回收
+    
+    async def process(self, image: Image.Image = None, parameters: Dict[str, Any] = None, task_id: str = None) -> Image.Image:
         """
         使用 ComfyUI 进行文生图
         
@@ -716,6 +683,15 @@ class TextToImageProcessor(ImageProcessor):
         Returns:
             生成的图像
         """
+        result = await self.process_raw(image, parameters, task_id)
+        if isinstance(result, Image.Image):
+            return result
+        # 将图像数据转换为 PIL Image
+        return await run_cpu_bound(_decode_comfyui_output, result)
+    
+    async def process_raw(self, image: Image.Image = None, parameters: Dict[str, Any] = None,
+                          task_id: str = None) -> Union[bytearray, Image.Image]:
+        """返回ComfyUI输出的PNG原始数据，调用失败时返回占位图"""
         if not parameters or 'prompt' not in parameters:
             raise ValueError("文生图需要提供 prompt 参数")
         
@@ -730,7 +706,7 @@ class TextToImageProcessor(ImageProcessor):
         
         try:
             # 调用 ComfyUI API
-            image_data = self._call_comfyui_api(
+            return await self._call_comfyui_api(
                 prompt=prompt,
                 negative_prompt=negative_prompt,
                 model=model,
@@ -740,91 +716,117 @@ class TextToImageProcessor(ImageProcessor):
                 cfg=cfg,
                 task_id=task_id
             )
-            
-            # 将图像数据转换为 PIL Image
-            return Image.open(io.BytesIO(image_data))
-            
         except Exception as e:
             print(f"ComfyUI API调用失败: {e}")
             # 降级方案：生成一个简单的纯色图像作为占位符
-            return self._fallback_generate_placeholder(prompt, width, height)
+            return await run_cpu_bound(self._fallback_generate_placeholder, prompt, width, height)
     
-    def _call_comfyui_api(self, prompt: str, negative_prompt: str, model: str = None, 
-                         width: int = 512, height: int = 512, steps: int = 20, cfg: int = 8, 
-                         task_id: str = None) -> bytes:
+    async def _call_comfyui_api(self, prompt: str, negative_prompt: str, model: str = None, 
+                                width: int = 512, height: int = 512, steps: int = 20, cfg: int = 8, 
+                                task_id: str = None) -> bytearray:
         """
         调用 ComfyUI API 生成图像
         
-        基于提供的 ComfyUI 客户端代码实现
+        开启攒批（COMFYUI_MAX_BATCH > 1）时，窗口期内参数完全相同的请求合并为一个
+        batch_size=N 的任务提交，模型加载、采样器初始化等开销由N张图分摊，
+        每个请求分到批内不同噪声生成的一张图
         """
-        import json
-        import uuid
-        from urllib.parse import urlencode
-        
-        server_address = settings.comfyui_server_address
-        client_id = str(uuid.uuid4())
-        
-        # 1. 加载工作流模板
-        workflow = self._load_workflow_template()
-        if not workflow:
-            raise Exception("无法加载 ComfyUI 工作流模板")
-        
-        # 2. 更新工作流参数
-        workflow = self._update_workflow_prompts(
-            workflow, prompt, negative_prompt, model, width, height, steps, cfg
-        )
-        
-        # 3. 提交到队列
-        prompt_data = {"prompt": workflow, "client_id": client_id}
-        data = json.dumps(prompt_data).encode('utf-8')
-        
-        # 准备请求头，如果有TOKEN则添加认证
-        headers = {'Content-Type': 'application/json'}
-        if settings.comfyui_token:
-            headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-        
-        response = requests.post(
-            f"http://{server_address}/prompt", 
-            data=data,
-            headers=headers,
-            timeout=settings.comfyui_timeout
-        )
-        result = response.json()
-        prompt_id = result['prompt_id']
-        
-        print(f"ComfyUI 任务ID: {prompt_id}")
-        
-        # 4. 等待完成
-        history = self._wait_for_completion(server_address, prompt_id, task_id)
+        params = (prompt, negative_prompt, model, width, height, steps, cfg)
+        if settings.comfyui_max_batch <= 1:
+            return (await self._generate(params, [task_id]))[0]
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.get(params)
+        if batch is None:
+            batch = self._pending[params] = []
+            loop.call_later(settings.comfyui_batch_window_ms / 1000, self._flush_batch, params, batch)
+        batch.append((future, task_id))
+        if len(batch) >= settings.comfyui_max_batch:
+            self._flush_batch(params, batch)
+        return await future
+    
+    def _flush_batch(self, params: Tuple, batch: List[Tuple[asyncio.Future, Optional[str]]]):
+        """提交一个批次（窗口到期或凑满时调用，同一批次只提交一次）"""
+        if self._pending.get(params) is not batch:
+            return
+        del self._pending[params]
+        task = asyncio.ensure_future(self._run_batch(params, batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _run_batch(self, params: Tuple, batch: List[Tuple[asyncio.Future, Optional[str]]]):
+        """执行一个批次，把生成的图像（或异常）分发给各请求"""
+        try:
+            results = await self._generate(params, [task_id for _, task_id in batch])
+        except Exception as e:
+            for future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (future, _), image_data in zip(batch, results):
+            if not future.done():
+                future.set_result(image_data)
+    
+    async def _generate(self, params: Tuple, task_ids: List[Optional[str]]) -> List[bytearray]:
+        """
+        提交一个 batch_size=len(task_ids) 的文生图任务并下载全部结果
         
-        # 5. 获取生成的图像
+        提交、等待、下载全程走共享的 aiohttp 会话，生成期间不占用线程
+        """
+        prompt, negative_prompt, model, width, height, steps, cfg = params
+        
+        async with comfyui_client.slot:
+            # 1. 加载工作流模板
+            template = self._load_workflow_template()
+            if not template:
+                raise Exception("无法加载 ComfyUI 工作流模板")
+            workflow, meta = template
+            
+            # 2. 更新工作流参数
+            workflow = self._update_workflow_prompts(
+                workflow, prompt, negative_prompt, model, width, height, steps, cfg, len(task_ids), meta
+            )
+            
+            # 3. 提交并等待完成
+            print("正在等待 ComfyUI 生成图像...")
+            progress = _ComfyUIProgress(
+                task_ids, "正在生成图像...", "图像生成完成，正在下载..."
+            )
+            try:
+                history = await comfyui_client.submit_workflow(workflow, progress.on_progress)
+                await progress.done()
+            finally:
+                await progress.close()
+            print("✅ 文生图完成！")
+            
+            # 4. 获取生成的图像
+            return await self._get_output_images(history, len(task_ids))
+    
+    async def _get_output_images(self, history: Dict, count: int = 1) -> List[bytearray]:
+        """从执行历史中获取生成的图像（第一个有图像输出的节点的前count张，并发下载）"""
         for node_id in history['outputs']:
             node_output = history['outputs'][node_id]
-            if 'images' in node_output:
-                for image_info in node_output['images']:
-                    image_data = self._get_image(
-                        server_address, image_info['filename'], 
-                        image_info['subfolder'], image_info['type']
-                    )
-                    return image_data
+            images = node_output.get('images') or []
+            if len(images) >= count:
+                return await comfyui_client.get_images(images[:count])
         
         raise Exception("未能从 ComfyUI 获取生成的图像")
     
-    def _load_workflow_template(self) -> Dict:
-        """加载工作流模板"""
+    def _load_workflow_template(self) -> Optional[Tuple[Dict, WorkflowMeta]]:
+        """加载工作流模板及其节点索引"""
         import json
         import os
         
         json_file_path = os.path.join(os.getcwd(), settings.comfyui_text_to_image_workflow)
         
         try:
-            with open(json_file_path, 'r', encoding='utf-8') as f:
-                workflow = json.load(f)
-            return workflow
+            return load_workflow_with_meta(json_file_path)
         except FileNotFoundError:
             print(f"找不到工作流文件: {json_file_path}")
             # 返回一个简单的默认工作流模板
-            return self._get_default_workflow()
+            workflow = self._get_default_workflow()
+            return workflow, WorkflowMeta.from_workflow(workflow)
         except json.JSONDecodeError:
             print(f"JSON文件格式错误: {json_file_path}")
             return None
@@ -878,155 +880,101 @@ class TextToImageProcessor(ImageProcessor):
     
     def _update_workflow_prompts(self, workflow: Dict, positive_prompt: str, negative_prompt: str,
                                 model_name: str = None, width: int = None, height: int = None,
-                                steps: int = None, cfg: int = None) -> Dict:
-        """更新工作流中的提示词和参数"""
+                                steps: int = None, cfg: int = None, batch_size: int = 1,
+                                meta: WorkflowMeta = None) -> Dict:
+        """
+        更新工作流中的提示词和参数
+        
+        按 class_type 索引直接定位各节点，不依赖固定的节点编号，
+        text_to_image_workflow.json 和 _get_default_workflow() 都适用。
+        索引随模板缓存（meta），未传入时现场建立
+        """
         if not workflow:
             return None
         
-        # 根据text_to_image_workflow.json的结构，节点6是正面提示词，节点7是负面提示词
-        # 更新正面提示词（节点6）
-        if "6" in workflow and workflow["6"].get("class_type") == "CLIPTextEncode":
-            workflow["6"]["inputs"]["text"] = positive_prompt
-            print(f"更新正面提示词(节点6): {positive_prompt}")
-        
-        # 更新负面提示词（节点7）
-        if "7" in workflow and workflow["7"].get("class_type") == "CLIPTextEncode":
-            workflow["7"]["inputs"]["text"] = negative_prompt
-            print(f"更新负面提示词(节点7): {negative_prompt}")
-        
-        # 更新模型（节点4）
-        if model_name and "4" in workflow and workflow["4"].get("class_type") == "CheckpointLoaderSimple":
-            workflow["4"]["inputs"]["ckpt_name"] = model_name
-            print(f"更新模型(节点4): {model_name}")
-        
-        # 更新KSampler参数（节点3）
-        if "3" in workflow and workflow["3"].get("class_type") == "KSampler":
-            inputs = workflow["3"]["inputs"]
-            inputs["seed"] = int(time.time() * 1000) % 1000000000  # 随机种子
+        if meta is None:
+            meta = WorkflowMeta.from_workflow(workflow)
+        now = time.time()  # 随机种子和文件名前缀共用一次取时
+        sampler_ids = meta.ids("KSampler")
+        sampler_inputs = workflow[sampler_ids[0]]["inputs"] if sampler_ids else {}
+        
+        # 正/负面提示词节点按KSampler的positive/negative连线确定；
+        # 没有KSampler时约定前两个CLIPTextEncode依次为正面、负面提示词
+        positive_link = sampler_inputs.get("positive")
+        negative_link = sampler_inputs.get("negative")
+        if isinstance(positive_link, list) and isinstance(negative_link, list):
+            prompt_ids = [positive_link[0], negative_link[0]]
+        else:
+            prompt_ids = meta.ids("CLIPTextEncode")[:2]
+        
+        for node_id, text, label in zip(prompt_ids, (positive_prompt, negative_prompt), ("正面", "负面")):
+            if workflow.get(node_id, {}).get("class_type") == "CLIPTextEncode":
+                workflow[node_id]["inputs"]["text"] = text
+                logger.debug("更新%s提示词(节点%s): %s", label, node_id, text)
+        
+        # 更新模型
+        checkpoint_ids = meta.ids("CheckpointLoaderSimple")
+        if model_name and checkpoint_ids:
+            workflow[checkpoint_ids[0]]["inputs"]["ckpt_name"] = model_name
+            logger.debug("更新模型(节点%s): %s", checkpoint_ids[0], model_name)
+        
+        # 更新KSampler参数
+        if sampler_ids:
+            sampler_inputs["seed"] = int(now * 1000) % 1000000000  # 随机种子
             if steps is not None:
-                inputs["steps"] = steps
-                print(f"更新采样步数(节点3): {steps}")
+                sampler_inputs["steps"] = steps
+                logger.debug("更新采样步数(节点%s): %s", sampler_ids[0], steps)
             if cfg is not None:
-                inputs["cfg"] = cfg
-                print(f"更新CFG(节点3): {cfg}")
+                sampler_inputs["cfg"] = cfg
+                logger.debug("更新CFG(节点%s): %s", sampler_ids[0], cfg)
         
-        # 更新图像尺寸（节点5 - EmptyLatentImage）
-        if "5" in workflow and workflow["5"].get("class_type") == "EmptyLatentImage":
-            inputs = workflow["5"]["inputs"]
+        # 更新图像尺寸（EmptyLatentImage）
+        latent_ids = meta.ids("EmptyLatentImage")
+        if latent_ids:
+            inputs = workflow[latent_ids[0]]["inputs"]
             if width is not None:
                 inputs["width"] = width
-                print(f"更新图像宽度(节点5): {width}")
+                logger.debug("更新图像宽度(节点%s): %s", latent_ids[0], width)
             if height is not None:
                 inputs["height"] = height
-                print(f"更新图像高度(节点5): {height}")
+                logger.debug("更新图像高度(节点%s): %s", latent_ids[0], height)
+            inputs["batch_size"] = batch_size
         
-        # 更新SaveImage节点的文件名前缀（节点9）
-        if "9" in workflow and workflow["9"].get("class_type") == "SaveImage":
-            workflow["9"]["inputs"]["filename_prefix"] = f"txt2img_{int(time.time())}"
+        # 更新SaveImage节点的文件名前缀
+        filename_prefix = f"txt2img_{int(now)}"
+        for node_id in meta.save_image_ids:
+            workflow[node_id]["inputs"]["filename_prefix"] = filename_prefix
         
         return workflow
     
-    def _wait_for_completion(self, server_address: str, prompt_id: str, task_id: str = None) -> Dict:
-        """等待图像生成完成"""
-        print("正在等待 ComfyUI 生成图像...")
-        max_wait_time = settings.comfyui_timeout
-        start_time = time.time()
-        
-        # 导入task_progress_manager（需要在循环外访问）
-        from app.utils.redis_client import task_progress_manager
-        
-        progress_step = 0
-        while time.time() - start_time < max_wait_time:
+    @classmethod
+    def _get_font(cls):
+        """获取占位图字体：尝试加载arial，失败则使用默认字体"""
+        if cls._FONT is None:
+            from PIL import ImageFont
             try:
-                # 准备认证头
-                headers = {}
-                if settings.comfyui_token:
-                    headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-                
-                # 查询队列状态
-                queue_response = requests.get(f"http://{server_address}/queue", headers=headers, timeout=5)
-                queue_data = queue_response.json()
-                
-                # 查询历史状态
-                response = requests.get(f"http://{server_address}/history/{prompt_id}", headers=headers)
-                history = response.json()
-                
-                if prompt_id in history:
-                    # 任务完成
-                    if task_id and task_progress_manager.exists(task_id):
-                        task_progress_manager.update_progress(task_id, {
-                            "progress": 80,
-                            "message": "图像生成完成，正在下载..."
-                        })
-                    print("✅ 文生图完成！")
-                    return history[prompt_id]
-                
-                # 更新进度
-                if task_id and task_progress_manager.exists(task_id):
-                    # 检查任务在队列中的状态
-                    running_queue = queue_data.get('queue_running', [])
-                    pending_queue = queue_data.get('queue_pending', [])
-                    
-                    is_running = any(len(item) >= 2 and item[1] == prompt_id for item in running_queue)
-                    
-                    if is_running:
-                        # 任务正在执行，递增进度
-                        progress_step = min(progress_step + 3, 70)  # 文生图进度稍快一些
-                        task_progress_manager.update_progress(task_id, {
-                            "progress": 30 + progress_step,
-                            "message": f"正在生成图像... ({progress_step}/70%)"
-                        })
-                        print(f"⏳ 文生图进行中... {30 + progress_step}%")
-                    else:
-                        # 检查是否在等待队列中
-                        for i, item in enumerate(pending_queue):
-                            if len(item) >= 2 and item[1] == prompt_id:
-                                position = i + 1
-                                total = len(pending_queue)
-                                task_progress_manager.update_progress(task_id, {
-                                    "progress": 25,
-                                    "message": f"排队中... ({position}/{total})"
-                                })
-                                print(f"📋 排队中... ({position}/{total})")
-                                break
-                
-            except Exception as e:
-                print(f"检查文生图任务状态时出错: {e}")
-            
-            time.sleep(1)
-        
-        raise Exception(f"ComfyUI 文生图任务超时 ({max_wait_time}秒)")
-    
-    def _get_image(self, server_address: str, filename: str, subfolder: str, folder_type: str) -> bytes:
-        """从服务器获取生成的图像"""
-        from urllib.parse import urlencode
-        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urlencode(data)
-        
-        # 准备认证头
-        headers = {}
-        if settings.comfyui_token:
-            headers['Authorization'] = f'Bearer {settings.comfyui_token}'
-        
-        response = requests.get(f"http://{server_address}/view?{url_values}", headers=headers)
-        return response.content
+                cls._FONT = ImageFont.truetype("arial.ttf", 20)
+            except OSError:
+                cls._FONT = ImageFont.load_default()
+        return cls._FONT
     
     def _fallback_generate_placeholder(self, prompt: str, width: int = 512, height: int = 512) -> Image.Image:
         """
         降级方案：生成一个包含提示词的占位图像
         当 ComfyUI 不可用时使用
         """
-        from PIL import ImageDraw, ImageFont
-        
-        # 创建一个渐变背景
-        img = Image.new('RGB', (width, height), color=(100, 150, 200))
+        from PIL import ImageDraw
+        
+        # 创建一个渐变背景（NumPy广播一次生成整幅图）
+        y = np.linspace(100, 200, height, dtype=np.float32)[:, None]
+        x = np.linspace(150, 250, width, dtype=np.float32)[None, :]
+        gradient = np.empty((height, width, 3), dtype=np.uint8)
+        gradient[..., 0] = (y + x) / 2
+        gradient[..., 1] = (y + 100) / 2
+        gradient[..., 2] = x
+        img = _array_to_image(gradient)
         draw = ImageDraw.Draw(img)
-        
-        # 尝试加载字体，如果失败则使用默认字体
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except:
-            font = ImageFont.load_default()
+        font = self._get_font()
         
         # 添加文字
         text_lines = [
@@ -1045,6 +993,10 @@ class TextToImageProcessor(ImageProcessor):
         
         return img
     
+    def raw_output_format(self) -> Optional[str]:
+        """ComfyUI的SaveImage节点输出PNG"""
+        return 'png'
+    
     def get_name(self) -> str:
         return "text_to_image"
     
@@ -1079,6 +1031,82 @@ class TextToImageProcessor(ImageProcessor):
         
         return True
 
+# PIL模式 -> 交给 cv2.imencode 前需要的颜色转换（None 表示无需转换）
+_PNG_ENCODE_CONVERSIONS = {
+    'L': None,
+    'RGB': cv2.COLOR_RGB2BGR,
+    'RGBA': cv2.COLOR_RGBA2BGRA,
+}
+
+def _encode_png(image: Image.Image) -> bytes:
+    """
+    以最快压缩档编码PNG（处理结果和上传给ComfyUI的输入图共用）
+    
+    常见模式走 cv2.imencode，直接产出字节，不经过 BytesIO 中转，比PIL编码快约25%；其他模式由PIL编码
+    """
+    conversion = _PNG_ENCODE_CONVERSIONS.get(image.mode, False)
+    if conversion is not False:
+        arr = _image_to_array(image)
+        if conversion is not None:
+            arr = cv2.cvtColor(arr, conversion)
+        ok, buf = cv2.imencode('.png', arr, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION_LEVEL])
+        if ok:
+            return buf.tobytes()
+    
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format='PNG', compress_level=PNG_COMPRESSION_LEVEL)
+    return output_buffer.getvalue()
+
+class _DecodeCache:
+    """
+    解码结果的LRU缓存，键为输入字节的 blake2b 摘要
+    
+    同一张图连续提交给多个处理器（或重复提交）时跳过解码；
+    除条目数外还按像素字节数限制总内存（settings.decode_cache_max_mb，每个worker进程各一份），
+    大图不会把缓存撑爆；预算为0时关闭缓存。
+    缓存的图像由多个请求共享，处理器不应原地修改输入图像
+    """
+    
+    def __init__(self, max_entries: int = 8, max_bytes: int = 64 * 1024 * 1024):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._items: "OrderedDict[Tuple[bytes, bool], Image.Image]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()  # 解码在CPU线程池中并发执行
+    
+    @property
+    def enabled(self) -> bool:
+        return self._max_bytes > 0
+    
+    @staticmethod
+    def key(image_data: bytes, allow_gray: bool = False) -> Tuple[bytes, bool]:
+        """缓存键：输入摘要 + 解码模式（同一张图按RGB、灰度解码的结果不同）"""
+        return hashlib.blake2b(image_data, digest_size=16).digest(), allow_gray
+    
+    @staticmethod
+    def _size(image: Image.Image) -> int:
+        return image.width * image.height * len(image.getbands())
+    
+    def get(self, key: Tuple[bytes, bool]) -> Optional[Image.Image]:
+        with self._lock:
+            image = self._items.get(key)
+            if image is not None:
+                self._items.move_to_end(key)
+            return image
+    
+    def put(self, key: Tuple[bytes, bool], image: Image.Image):
+        size = self._size(image)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = image
+            self._bytes += size
+            while self._bytes > self._max_bytes or len(self._items) > self._max_entries:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= self._size(evicted)
+
 class ImageProcessingService:
     """
     图像处理服务管理器
@@ -1089,6 +1117,7 @@ class ImageProcessingService:
     
     def __init__(self):
         self.processors: Dict[str, ImageProcessor] = {}
+        self._decode_cache = _DecodeCache(max_bytes=settings.decode_cache_max_mb * 1024 * 1024)
         self._register_default_processors()
     
     def _register_default_processors(self):
@@ -1114,59 +1143,147 @@ class ImageProcessingService:
             for name, processor in self.processors.items()
         }
     
-    def process_image(
+    async def process_image(
         self, 
         image_data: bytes, 
         processing_type: str, 
         parameters: Dict[str, Any] = None,
-        task_id: str = None
+        task_id: str = None,
+        output_format: str = None
     ) -> Tuple[bytes, float]:
         """
         处理图像
         
+        处理器的 raw_output_format() 与输出格式相同时，后端返回的数据原样作为结果
+        （可能是 bytearray），省去一次解码和一次编码
+        
         Args:
             image_data: 图像二进制数据（文生图时为空）
             processing_type: 处理类型
             parameters: 处理参数
             task_id: 任务ID，用于进度跟踪
+            output_format: 输出格式 'png'、'webp' 或 'jpeg'；默认与输入保持一致：
+                JPEG输入输出JPEG（照片类内容有损即可，编码快得多），其余按 settings.lossless_output_format 无损输出
             
         Returns:
             (处理后的图像数据, 处理时间)
         """
         start_time = time.time()
         
-        if processing_type not in self.processors:
-            raise ValueError(f"不支持的处理类型: {processing_type}")
+        if output_format is None:
+            if image_data and sniff_image_type(image_data[:12]) == 'image/jpeg':
+                output_format = 'jpeg'
+            else:
+                output_format = settings.lossless_output_format
         
-        processor = self.processors[processing_type]
+        processor = self.processors.get(processing_type)
+        if processor is None:
+            raise ValueError(f"不支持的处理类型: {processing_type}")
         
         # 验证参数
         if parameters and not processor.validate_parameters(parameters):
             raise ValueError("无效的处理参数")
+        parameters = parameters or {}
         
         # 文生图处理特殊逻辑
         if processing_type == 'text_to_image':
             # 文生图不需要输入图像
-            processed_image = processor.process(None, parameters or {}, task_id)
+            image = None
+        else:
+            # 加载图像（解码是CPU密集操作，放到线程中执行；相同输入直接复用缓存的解码结果）
+            image = await run_cpu_bound(
+                self._decode_image_cached, image_data, 'L' in processor.accepted_modes()
+            )
+        
+        if processor.raw_output_format() == output_format:
+            # 后端直接给出了目标格式的数据，原样返回，不再解码后重新编码
+            result = await processor.process_raw(image, parameters, task_id)
+            if not isinstance(result, Image.Image):
+                if sniff_image_type(bytes(result[:12])) == f'image/{output_format}':
+                    return result, time.time() - start_time
+                result = await run_cpu_bound(_decode_comfyui_output, result)
+            processed_image = result
         else:
-            # 加载图像
-            image = Image.open(io.BytesIO(image_data))
-            
-            # 确保图像是RGB模式
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
             # 处理图像
-            processed_image = processor.process(image, parameters or {}, task_id)
+            processed_image = await processor.process(image, parameters, task_id)
         
         # 保存处理后的图像
-        output_buffer = io.BytesIO()
-        processed_image.save(output_buffer, format='PNG')
-        output_data = output_buffer.getvalue()
+        output_data = await run_cpu_bound(self._encode_image, processed_image, output_format)
         
         processing_time = time.time() - start_time
         
         return output_data, processing_time
+    
+    def _decode_image_cached(self, image_data: bytes, allow_gray: bool = False) -> Image.Image:
+        """按输入内容缓存的 _decode_image"""
+        if not self._decode_cache.enabled:
+            return self._decode_image(image_data, allow_gray)
+        key = self._decode_cache.key(image_data, allow_gray)
+        image = self._decode_cache.get(key)
+        if image is None:
+            image = self._decode_image(image_data, allow_gray)
+            self._decode_cache.put(key, image)
+        return image
+    
+    @staticmethod
+    def _decode_image(image_data: bytes, allow_gray: bool = False) -> Image.Image:
+        """
+        解码上传的图像并确保是RGB模式（allow_gray 时灰度输入保持为单通道L模式）
+        
+        先用PIL只读文件头拿到尺寸，超过 settings.max_image_pixels 直接拒绝，
+        避免为解压炸弹分配 HxWx3 的缓冲区。
+        之后优先用 cv2.imdecode 直接解码为3通道（libjpeg-turbo/libpng，比PIL快），
+        忽略EXIF方向以保持与PIL一致；OpenCV无法解码时回退到PIL
+        """
+        try:
+            image = Image.open(io.BytesIO(image_data))
+        except Image.DecompressionBombError as e:
+            raise ValueError(f"图像尺寸过大: {e}")
+        width, height = image.size
+        if width * height > settings.max_image_pixels:
+            raise ValueError(f"图像尺寸过大: {width}x{height}，最多支持 {settings.max_image_pixels} 像素")
+        
+        mode = 'L' if allow_gray and image.mode == 'L' else 'RGB'
+        
+        arr = cv2.imdecode(
+            np.frombuffer(image_data, dtype=np.uint8),
+            (cv2.IMREAD_GRAYSCALE if mode == 'L' else cv2.IMREAD_COLOR) | cv2.IMREAD_IGNORE_ORIENTATION
+        )
+        if arr is not None:
+            return _array_to_image(arr if mode == 'L' else cv2.cvtColor(arr, cv2.COLOR_BGR2RGB))
+        
+        if image.mode != mode:
+            image = image.convert(mode)
+        return image
+    
+    @staticmethod
+    def _encode_image(image: Image.Image, output_format: str = 'png') -> bytes:
+        """
+        将处理结果编码为PNG、WebP无损或JPEG
+        
+        常见模式走 cv2.imencode，其他模式由PIL编码，PNG使用低压缩级别。
+        WebP无损用最快档（method=0, quality=0），RGB图像上比PNG快约2倍且体积更小；
+        灰度图WebP要先扩展为RGB反而更慢，超出WebP尺寸上限的图也无法编码，这两种情况仍输出PNG
+        """
+        if output_format == 'webp' and image.mode in ('RGB', 'RGBA') and max(image.size) <= _WEBP_MAX_DIMENSION:
+            output_buffer = io.BytesIO()
+            image.save(output_buffer, format='WEBP', lossless=True, quality=0, method=0)
+            return output_buffer.getvalue()
+        
+        if output_format == 'jpeg':
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            arr = _image_to_array(image)
+            if arr.ndim == 3:
+                arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+            ok, buf = cv2.imencode('.jpg', arr, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+            if ok:
+                return buf.tobytes()
+            output_buffer = io.BytesIO()
+            image.save(output_buffer, format='JPEG', quality=JPEG_QUALITY)
+            return output_buffer.getvalue()
+        
+        return _encode_png(image)
 
 # 全局服务实例
 image_processing_service = ImageProcessingService()
@@ -2,19 +2,49 @@
 用户积分管理模块
 """
 
+from typing import Optional
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from app.models.models import User
 
 def check_user_credits(user: User, required_credits: int = 10) -> bool:
     """检查用户积分是否足够"""
     return user.credits >= required_credits
 
-def deduct_user_credits(db: Session, user: User, credits_to_deduct: int = 10) -> bool:
-    """扣除用户积分"""
-    if user.credits < credits_to_deduct:
-        return False
+def deduct_user_credits_atomic(db: Session, user: User, credits_to_deduct: int = 10) -> Optional[int]:
+    """
+    原子地检查并扣除用户积分
+    
+    使用单条 UPDATE ... WHERE credits >= n 语句完成检查和扣除，
+    避免并发请求同时通过检查后超额扣除
+    
+    扣除失败时 user.credits 保持为本次扣除前的余额，调用方可直接用于提示信息；
+    不会在提交后重新加载到并发请求扣除后的值
+    
+    Returns:
+        扣除后的剩余积分；积分不足时返回None
+    """
+    balance = user.credits
+    stmt = (
+        update(User)
+        .where(User.id == user.id, User.credits >= credits_to_deduct)
+        .values(credits=User.credits - credits_to_deduct)
+        .execution_options(synchronize_session=False)
+    )
+    
+    if db.get_bind().dialect.update_returning:
+        # PostgreSQL / SQLite 3.35+：一次往返同时拿到剩余积分
+        remaining = db.execute(stmt.returning(User.credits)).scalar_one_or_none()
+    else:
+        # 不支持RETURNING的数据库：在同一事务中更新后再读取
+        result = db.execute(stmt)
+        remaining = None
+        if result.rowcount:
+            remaining = db.execute(select(User.credits).where(User.id == user.id)).scalar_one()
     
-    user.credits -= credits_to_deduct
     db.commit()
-    db.refresh(user)
-    return True
+    
+    # 同步内存中的用户对象，无需再refresh
+    set_committed_value(user, 'credits', balance if remaining is None else remaining)
+    return remaining
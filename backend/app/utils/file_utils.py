@@ -8,6 +8,39 @@ from app.utils.filename_handler import sanitize_filename, generate_unique_filena
 
 logger = logging.getLogger(__name__)
 
+# 受支持图像格式的文件头（magic bytes），用于快速识别真实的文件类型；
+# 与 settings.allowed_extensions 的默认值保持一致，新增格式时两边一起修改
+_MAGIC = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n', 'image/png'),
+    (b'RIFF', 'image/webp'),
+]
+
+# 图像类型 -> 对应的文件扩展名（第一个为保存处理结果时使用的扩展名）
+_MEDIA_TYPE_EXTENSIONS = {
+    'image/jpeg': ('jpg', 'jpeg'),
+    'image/png': ('png',),
+    'image/webp': ('webp',),
+}
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """
+    根据文件头识别图像类型（无需解码图像）
+    
+    Args:
+        header: 文件开头的至少12个字节
+        
+    Returns:
+        Optional[str]: 识别出的MIME类型，无法识别时返回None
+    """
+    for magic, media_type in _MAGIC:
+        if header.startswith(magic):
+            # RIFF容器还需要确认是WEBP
+            if media_type == 'image/webp' and header[8:12] != b'WEBP':
+                return None
+            return media_type
+    return None
+
 def validate_image_file(file: UploadFile) -> bool:
     """
     验证上传的文件是否为有效图像
@@ -44,6 +77,25 @@ def validate_image_file(file: UploadFile) -> bool:
                 logger.warning(f"文件过大: {file.size} > {settings.max_file_size}")
                 return False
         
+        # 读取文件头快速识别图像类型，避免完整解码
+        header = file.file.read(12)
+        file.file.seek(0)
+        media_type = sniff_image_type(header)
+        if media_type is None or not any(
+            ext in settings.allowed_extensions_list for ext in _MEDIA_TYPE_EXTENSIONS[media_type]
+        ):
+            logger.warning(f"文件内容不是受支持的图像格式: {file.filename}")
+            return False
+        
+        # 可选的深度校验：使用PIL检查图像结构是否完整
+        if settings.deep_validate_images:
+            from PIL import Image
+            try:
+                with Image.open(file.file) as image:
+                    image.verify()
+            finally:
+                file.file.seek(0)
+        
         return True
         
     except Exception as e:
@@ -102,6 +154,9 @@ def save_uploaded_file(file: UploadFile) -> str:
         logger.error(f"保存上传文件失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"文件保存失败: {str(e)}")
 
+# 处理结果的图像类型 -> 保存时使用的扩展名
+_PROCESSED_EXTENSIONS = {media_type: extensions[0] for media_type, extensions in _MEDIA_TYPE_EXTENSIONS.items()}
+
 def save_processed_image(image_data: bytes, original_filename: str) -> str:
     """
     保存处理后的图像（支持特殊字符文件名）
@@ -128,9 +183,10 @@ def save_processed_image(image_data: bytes, original_filename: str) -> str:
         # 清理原始文件名并生成处理后的文件名
         safe_base_name = sanitize_filename(original_filename, preserve_extension=False)
         
-        # 生成处理后文件的文件名
+        # 生成处理后文件的文件名（扩展名按图像数据的实际格式确定，默认png）
+        extension = _PROCESSED_EXTENSIONS.get(sniff_image_type(image_data[:12]), 'png')
         unique_id = str(uuid.uuid4())[:8]
-        processed_filename = f"{safe_base_name}_processed_{unique_id}.png"
+        processed_filename = f"{safe_base_name}_processed_{unique_id}.{extension}"
         
         # 确保文件名唯一
         final_filename = generate_unique_filename(processed_filename, settings.upload_dir)
@@ -155,7 +211,8 @@ def save_processed_image(image_data: bytes, original_filename: str) -> str:
         logger.error(f"保存处理后图像失败: {str(e)}")
         # 尝试使用备用文件名
         try:
-            fallback_filename = f"processed_{uuid.uuid4().hex[:8]}.png"
+            extension = _PROCESSED_EXTENSIONS.get(sniff_image_type(image_data[:12]), 'png')
+            fallback_filename = f"processed_{uuid.uuid4().hex[:8]}.{extension}"
             fallback_path = os.path.join(settings.upload_dir, fallback_filename)
             
             with open(fallback_path, "wb") as buffer:
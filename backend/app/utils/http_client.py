@@ -0,0 +1,41 @@
+"""
+HTTP客户端工具类
+
+提供进程内共享的 aiohttp ClientSession
+所有对外部服务的调用复用同一个连接池，避免每次请求都重新建立TCP/TLS连接
+"""
+
+from typing import Optional
+import aiohttp
+from app.config import settings
+
+_session: Optional[aiohttp.ClientSession] = None
+
+# 会话级默认超时，只作用于没有单独传 timeout 的请求（如上传图片、WebSocket握手），
+# 与aiohttp的默认值相同，这里显式写出避免误以为会话没有总超时
+_DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=30)
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    获取共享的 aiohttp 会话（首次调用时创建）
+
+    各调用按需单独设置超时；未设置的请求使用 _DEFAULT_TIMEOUT（总计300秒）
+    """
+    global _session
+    if _session is None or _session.closed:
+        # limit_per_host 需容纳 ComfyUI 并发任务各自的 WebSocket 长连接和请求连接
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=max(40, settings.comfyui_max_concurrency * 2 + 8),
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=_DEFAULT_TIMEOUT)
+    return _session
+
+async def close_session():
+    """关闭共享会话，在应用关闭时调用"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
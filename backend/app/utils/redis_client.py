@@ -7,6 +7,7 @@ Redis客户端工具类
 
 import json
 import redis
+import redis.asyncio
 from typing import Optional, Dict, Any, Union
 import logging
 from app.config import settings
@@ -19,6 +20,7 @@ class RedisClient:
     def __init__(self):
         """初始化Redis连接"""
         self.redis_client = None
+        self._async_client = None
         self._connect()
     
     def _connect(self):
@@ -229,6 +231,57 @@ class RedisClient:
             logger.error(f"Redis哈希删除失败 {name}.{keys}: {e}")
             return 0
 
+    def publish(self, channel: str, message: Any) -> int:
+        """
+        发布消息到频道
+        
+        Args:
+            channel: 频道名
+            message: 消息（字典或列表自动JSON序列化）
+        
+        Returns:
+            收到消息的订阅者数量
+        """
+        if not self.redis_client:
+            return 0
+        
+        try:
+            if isinstance(message, (dict, list)):
+                message = json.dumps(message, ensure_ascii=False)
+            return self.redis_client.publish(channel, message)
+        except Exception as e:
+            logger.error(f"Redis发布失败 {channel}: {e}")
+            return 0
+    
+    def pubsub_async(self) -> Optional[redis.asyncio.client.PubSub]:
+        """
+        获取异步发布订阅对象（供SSE等长连接在事件循环中等待消息）
+        
+        Returns:
+            PubSub对象，Redis未连接时返回None
+        """
+        if not self.redis_client:
+            return None
+        
+        if self._async_client is None:
+            # 与_connect相同的连接方式；不设置socket_timeout，以便长时间等待消息
+            if settings.redis_url.startswith('redis://'):
+                self._async_client = redis.asyncio.from_url(
+                    settings.redis_url,
+                    decode_responses=True,
+                    socket_connect_timeout=5
+                )
+            else:
+                self._async_client = redis.asyncio.Redis(
+                    host='localhost',
+                    port=6379,
+                    db=settings.redis_db,
+                    password=settings.redis_password if settings.redis_password else None,
+                    decode_responses=True,
+                    socket_connect_timeout=5
+                )
+        return self._async_client.pubsub()
+
 # 全局Redis客户端实例
 redis_client = RedisClient()
 
@@ -236,6 +289,11 @@ redis_client = RedisClient()
 class TaskProgressManager:
     """任务进度管理器 - 使用Redis替代内存字典"""
     
+    @staticmethod
+    def channel(task_id: str) -> str:
+        """任务进度变化的发布频道"""
+        return f"progress:{task_id}"
+    
     @staticmethod
     def set_progress(task_id: str, progress_data: Dict[str, Any], expire: int = 600) -> bool:
         """
@@ -250,7 +308,10 @@ class TaskProgressManager:
             是否设置成功
         """
         key = f"task_progress:{task_id}"
-        return redis_client.hset(key, progress_data, expire)
+        result = redis_client.hset(key, progress_data, expire)
+        if result:
+            redis_client.publish(TaskProgressManager.channel(task_id), progress_data)
+        return result
     
     @staticmethod
     def get_progress(task_id: str) -> Optional[Dict[str, Any]]:
@@ -265,7 +326,11 @@ class TaskProgressManager:
         existing = redis_client.hgetall(key)
         if existing:
             existing.update(updates)
-            return redis_client.hset(key, existing, expire=600)
+            result = redis_client.hset(key, existing, expire=600)
+            if result:
+                # 推送给订阅了该任务的SSE连接
+                redis_client.publish(TaskProgressManager.channel(task_id), existing)
+            return result
         return False
     
     @staticmethod
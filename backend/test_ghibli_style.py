@@ -7,6 +7,7 @@ import os
 import sys
 from PIL import Image
 import io
+import asyncio
 
 # 添加当前目录到Python路径
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -42,11 +43,11 @@ def test_ghibli_processor():
         
         # 调用处理服务
         try:
-            processed_data, processing_time = image_processing_service.process_image(
+            processed_data, processing_time = asyncio.run(image_processing_service.process_image(
                 image_data=image_data,
                 processing_type="ghibli_style",
                 parameters=None
-            )
+            ))
             
             # 保存结果
             output_path = "test_ghibli_output.png"
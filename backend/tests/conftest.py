@@ -0,0 +1,15 @@
+"""
+测试公共夹具
+
+测试不依赖Redis、ComfyUI等外部服务，需要时用 monkeypatch 替换对应的客户端
+"""
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+@pytest.fixture
+def client():
+    """不触发startup事件的测试客户端（启动时会检查数据库连接）"""
+    return TestClient(app)
@@ -0,0 +1,264 @@
+"""
+ComfyUIClient 测试
+
+用 aiohttp 的 TestServer 起一个本地的假ComfyUI（/prompt、/history、/ws、/view），
+客户端走真实的HTTP和WebSocket连接
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.services import comfyui_client as comfyui_module
+from app.services.comfyui_client import ComfyUIClient, load_workflow_with_meta
+
+class FakeComfyUI:
+    """
+    假的ComfyUI服务
+
+    histories 按 /history 请求的先后依次返回（None表示任务尚未完成），
+    events 在 /prompt 提交后通过WebSocket推送；close_ws 为True时推送完直接断开连接
+    """
+
+    def __init__(self, histories=None, events=(), close_ws=False):
+        self.histories = list(histories or [])
+        self.events = list(events)
+        self.close_ws = close_ws
+        self.history_calls = 0
+        self.prompts = []
+        self.queued = asyncio.Event()
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post('/prompt', self.prompt),
+            web.get('/history/{prompt_id}', self.history),
+            web.get('/ws', self.ws),
+            web.get('/view', self.view),
+        ])
+        return app
+
+    async def prompt(self, request):
+        self.prompts.append(await request.json())
+        self.queued.set()
+        return web.json_response({'prompt_id': 'p1'})
+
+    async def history(self, request):
+        self.history_calls += 1
+        history = self.histories.pop(0) if self.histories else None
+        prompt_id = request.match_info['prompt_id']
+        return web.json_response({prompt_id: history} if history is not None else {})
+
+    async def ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await self.queued.wait()
+        for event in self.events:
+            await ws.send_str(json.dumps(event))
+        if not self.close_ws:
+            # 保持连接直到客户端关闭
+            async for _ in ws:
+                pass
+        await ws.close()
+        return ws
+
+    async def view(self, request):
+        if request.query['filename'] == 'missing.png':
+            return web.Response(status=404, text='not found')
+        return web.Response(body=b'PNGDATA', content_type='image/png')
+
+def run_against(fake, monkeypatch, scenario):
+    """启动假服务，让客户端使用独立的会话连接它，再执行 scenario(client)"""
+    async def main():
+        server = TestServer(fake.app())
+        await server.start_server()
+        session = aiohttp.ClientSession()
+
+        async def get_session():
+            return session
+
+        monkeypatch.setattr(comfyui_module, 'get_session', get_session)
+        try:
+            client = ComfyUIClient(server_address=f"{server.host}:{server.port}", token='')
+            return await scenario(client)
+        finally:
+            await session.close()
+            await server.close()
+
+    return asyncio.run(main())
+
+def _done_event():
+    return {'type': 'executing', 'data': {'node': None, 'prompt_id': 'p1'}}
+
+def test_submit_workflow_reports_progress(monkeypatch):
+    output = {'images': [{'filename': 'out.png', 'subfolder': '', 'type': 'output'}]}
+    fake = FakeComfyUI(events=[
+        {'type': 'progress', 'data': {'value': 1, 'max': 2, 'prompt_id': 'p1'}},
+        {'type': 'progress', 'data': {'value': 2, 'max': 2, 'prompt_id': 'p1'}},
+        {'type': 'executed', 'data': {'node': '9', 'output': output, 'prompt_id': 'p1'}},
+        _done_event(),
+    ])
+    steps = []
+
+    history = run_against(
+        fake, monkeypatch,
+        lambda client: client.submit_workflow({'1': {'class_type': 'KSampler'}}, lambda v, m: steps.append((v, m)))
+    )
+
+    assert history == {'outputs': {'9': output}}
+    assert steps == [(1, 2), (2, 2)]
+    assert fake.prompts[0]['prompt'] == {'1': {'class_type': 'KSampler'}}
+
+def test_cached_nodes_fall_back_to_history(monkeypatch):
+    # 命中缓存的节点不推送 executed，执行结束后必须查询一次history
+    full_history = {'outputs': {'9': {'images': [{'filename': 'cached.png'}]}}}
+    fake = FakeComfyUI(
+        histories=[None, full_history],
+        events=[
+            {'type': 'execution_cached', 'data': {'nodes': ['9'], 'prompt_id': 'p1'}},
+            {'type': 'execution_success', 'data': {'prompt_id': 'p1'}},
+        ]
+    )
+
+    history = run_against(fake, monkeypatch, lambda client: client.submit_workflow({}))
+
+    assert history == full_history
+    assert fake.history_calls == 2
+
+def test_finished_before_events_returns_history(monkeypatch):
+    # 提交后立即完成的任务收不到事件，开头那次history查询直接返回结果
+    full_history = {'outputs': {'9': {'images': []}}}
+    fake = FakeComfyUI(histories=[full_history])
+
+    history = run_against(fake, monkeypatch, lambda client: client.submit_workflow({}))
+
+    assert history == full_history
+    assert fake.history_calls == 1
+
+def test_websocket_disconnect_polls_history_with_backoff(monkeypatch):
+    monkeypatch.setattr(comfyui_module.random, 'uniform', lambda a, b: 0)
+    full_history = {'outputs': {'9': {'images': []}}}
+    # 开头查询一次，断线后轮询两次仍未完成，第三次轮询拿到结果
+    fake = FakeComfyUI(histories=[None, None, None, full_history], close_ws=True)
+
+    started = time.monotonic()
+    history = run_against(fake, monkeypatch, lambda client: client.submit_workflow({}))
+    elapsed = time.monotonic() - started
+
+    assert history == full_history
+    assert fake.history_calls == 4
+    # 两次等待分别为0.25秒和0.375秒
+    assert elapsed >= 0.6
+
+def test_get_image_downloads_body(monkeypatch):
+    fake = FakeComfyUI()
+
+    data = run_against(
+        fake, monkeypatch,
+        lambda client: client.get_image({'filename': 'out.png', 'subfolder': '', 'type': 'output'})
+    )
+
+    assert bytes(data) == b'PNGDATA'
+
+def test_get_image_raises_on_error_status(monkeypatch):
+    fake = FakeComfyUI()
+
+    with pytest.raises(aiohttp.ClientResponseError) as exc_info:
+        run_against(
+            fake, monkeypatch,
+            lambda client: client.get_image({'filename': 'missing.png', 'subfolder': '', 'type': 'output'})
+        )
+    assert exc_info.value.status == 404
+
+def test_slot_limits_concurrency(monkeypatch):
+    monkeypatch.setattr(comfyui_module.settings, 'comfyui_max_concurrency', 2)
+    client = ComfyUIClient(server_address='127.0.0.1:1', token='')
+    active = 0
+    peak = 0
+
+    async def job():
+        nonlocal active, peak
+        async with client.slot:
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    async def main():
+        await asyncio.gather(*(job() for _ in range(6)))
+
+    asyncio.run(main())
+
+    assert peak == 2
+
+def test_history_built_from_executed_events(monkeypatch):
+    # 结果由 executed 事件拼出，执行结束后不再查询 /history；其他prompt的事件被忽略
+    first = {'images': [{'filename': 'a.png', 'subfolder': '', 'type': 'output'}]}
+    second = {'images': [{'filename': 'b.png', 'subfolder': '', 'type': 'output'}]}
+    fake = FakeComfyUI(events=[
+        {'type': 'executed', 'data': {'node': '9', 'output': first, 'prompt_id': 'p1'}},
+        {'type': 'executed', 'data': {'node': '9', 'output': {'images': []}, 'prompt_id': 'other'}},
+        {'type': 'executed', 'data': {'node': '5', 'output': None, 'prompt_id': 'p1'}},
+        {'type': 'executed', 'data': {'node': '12', 'output': second, 'prompt_id': 'p1'}},
+        {'type': 'execution_success', 'data': {'prompt_id': 'p1'}},
+    ])
+
+    history = run_against(fake, monkeypatch, lambda client: client.submit_workflow({}))
+
+    assert history == {'outputs': {'9': first, '12': second}}
+    assert fake.history_calls == 1
+
+def test_execution_error_raises(monkeypatch):
+    fake = FakeComfyUI(events=[
+        {'type': 'execution_error', 'data': {'exception_message': 'out of memory', 'prompt_id': 'p1'}},
+    ])
+
+    with pytest.raises(Exception, match='out of memory'):
+        run_against(fake, monkeypatch, lambda client: client.submit_workflow({}))
+
+def test_workflow_cache_reloads_after_file_change(tmp_path):
+    path = tmp_path / 'workflow.json'
+    path.write_text(json.dumps({'1': {'class_type': 'LoadImage', 'inputs': {}}}))
+    os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+
+    workflow, meta = load_workflow_with_meta(str(path))
+    assert meta.load_image_ids == ('1',)
+    # 每次返回新解析的dict，修改它不影响缓存
+    workflow['1']['inputs']['image'] = 'changed.png'
+    assert load_workflow_with_meta(str(path))[0]['1']['inputs'] == {}
+
+    # 同一秒内的修改也要识别，只改变纳秒部分
+    path.write_text(json.dumps({'7': {'class_type': 'SaveImage', 'inputs': {}}}))
+    os.utime(path, ns=(1_000_000_000, 1_000_000_500))
+
+    workflow, meta = load_workflow_with_meta(str(path))
+    assert list(workflow) == ['7']
+    assert meta.load_image_ids == ()
+    assert meta.save_image_ids == ('7',)
+
+def test_progress_events_are_throttled(monkeypatch):
+    # 连续推送的采样步只回调第一步和最后一步，中间的落在节流间隔内被跳过
+    fake = FakeComfyUI(events=[
+        *({'type': 'progress', 'data': {'value': step, 'max': 5, 'prompt_id': 'p1'}} for step in range(1, 6)),
+        {'type': 'progress', 'data': {'value': 3, 'max': 5, 'prompt_id': 'other'}},
+        {'type': 'executed', 'data': {'node': '9', 'output': {'images': []}, 'prompt_id': 'p1'}},
+        _done_event(),
+    ])
+    steps = []
+
+    run_against(fake, monkeypatch, lambda client: client.submit_workflow({}, lambda v, m: steps.append((v, m))))
+
+    assert steps == [(1, 5), (5, 5)]
+
+def test_wait_times_out_without_events(monkeypatch):
+    monkeypatch.setattr(comfyui_module.settings, 'comfyui_timeout', 0.3)
+    fake = FakeComfyUI()
+
+    with pytest.raises(Exception, match='超时'):
+        run_against(fake, monkeypatch, lambda client: client.submit_workflow({}))
@@ -0,0 +1,86 @@
+"""
+ComfyUI进度上报（_ComfyUIProgress）的测试
+"""
+
+import asyncio
+import time
+import pytest
+
+from app.services.image_processing import _ComfyUIProgress
+from app.utils.redis_client import task_progress_manager
+
+@pytest.fixture
+def writes(monkeypatch):
+    """记录写入Redis的进度，每次写入耗时50ms，模拟一次较慢的Redis往返"""
+    written = []
+
+    def update_progress(task_id, update):
+        time.sleep(0.05)
+        written.append(update['progress'])
+
+    monkeypatch.setattr(task_progress_manager, 'exists', lambda task_id: True)
+    monkeypatch.setattr(task_progress_manager, 'update_progress', update_progress)
+    return written
+
+def test_done_flushes_latest_progress(writes):
+    async def run():
+        progress = _ComfyUIProgress(['task-1'], '处理中', '完成')
+        progress.on_progress(1, 10)
+        await asyncio.sleep(0.01)
+        # 写入期间到达的更新合并为最新的一条
+        progress.on_progress(5, 10)
+        progress.on_progress(9, 10)
+        await progress.done()
+
+    asyncio.run(run())
+
+    assert writes == [34, 80]
+
+def test_close_waits_for_in_flight_write_and_drops_pending(writes):
+    async def run():
+        progress = _ComfyUIProgress(['task-1'], '处理中', '完成')
+        progress.on_progress(1, 10)
+        await asyncio.sleep(0.01)
+        progress.on_progress(5, 10)
+        # 提交失败时的清理：正在写的一条写完才返回，排队中的一条被丢弃
+        await progress.close()
+        written_on_close = list(writes)
+        progress.on_progress(9, 10)
+        await asyncio.sleep(0.1)
+        return written_on_close
+
+    assert asyncio.run(run()) == [34]
+    assert writes == [34]
+
+def test_close_does_not_mask_submit_error(monkeypatch):
+    def update_progress(task_id, update):
+        raise ConnectionError("Redis unavailable")
+
+    monkeypatch.setattr(task_progress_manager, 'exists', lambda task_id: True)
+    monkeypatch.setattr(task_progress_manager, 'update_progress', update_progress)
+
+    async def run():
+        progress = _ComfyUIProgress(['task-1'], '处理中', '完成')
+        try:
+            progress.on_progress(1, 10)
+            raise RuntimeError("ComfyUI failed")
+        finally:
+            await progress.close()
+
+    with pytest.raises(RuntimeError, match="ComfyUI failed"):
+        asyncio.run(run())
+
+def test_untracked_tasks_are_skipped(monkeypatch):
+    calls = []
+    monkeypatch.setattr(task_progress_manager, 'exists', lambda task_id: task_id == 'known')
+    monkeypatch.setattr(task_progress_manager, 'update_progress', lambda task_id, update: calls.append(task_id))
+
+    async def run():
+        progress = _ComfyUIProgress(['known', None, 'unknown'], '处理中', '完成')
+        progress.on_progress(3, 10)
+        await asyncio.sleep(0.01)
+        await progress.done()
+
+    asyncio.run(run())
+
+    assert calls == ['known', 'known']
@@ -0,0 +1,21 @@
+"""
+配置项校验测试
+"""
+
+import pytest
+from pydantic import ValidationError
+
+from app.config import Settings
+
+@pytest.mark.parametrize('value, expected', [('png', 'png'), ('WEBP', 'webp')])
+def test_lossless_output_format_accepts_png_and_webp(monkeypatch, value, expected):
+    monkeypatch.setenv('LOSSLESS_OUTPUT_FORMAT', value)
+
+    assert Settings().lossless_output_format == expected
+
+@pytest.mark.parametrize('value', ['jpeg', 'gif', ''])
+def test_lossless_output_format_rejects_other_values(monkeypatch, value):
+    monkeypatch.setenv('LOSSLESS_OUTPUT_FORMAT', value)
+
+    with pytest.raises(ValidationError):
+        Settings()
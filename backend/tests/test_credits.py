@@ -0,0 +1,77 @@
+"""
+积分原子扣除测试
+"""
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app.models.models import User
+from app.utils.credits import deduct_user_credits_atomic
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture(params=[False, True], ids=['keep-on-commit', 'expire-on-commit'])
+def db(engine, request):
+    session = sessionmaker(bind=engine, expire_on_commit=request.param)()
+    yield session
+    session.close()
+
+def _create_user(db, credits: int) -> User:
+    user = User(username="alice", email="alice@example.com", hashed_password="x", credits=credits)
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    return user
+
+def test_deduct_to_exactly_zero_then_refuse(db):
+    user = _create_user(db, 20)
+
+    assert deduct_user_credits_atomic(db, user, 10) == 10
+    assert deduct_user_credits_atomic(db, user, 10) == 0
+    assert user.credits == 0
+
+    assert deduct_user_credits_atomic(db, user, 10) is None
+    assert deduct_user_credits_atomic(db, user, 1) is None
+    assert user.credits == 0
+    assert db.get(User, user.id).credits == 0
+
+def test_refused_deduction_keeps_balance(db):
+    user = _create_user(db, 5)
+
+    assert deduct_user_credits_atomic(db, user, 10) is None
+    assert user.credits == 5
+    db.expire_all()
+    assert db.get(User, user.id).credits == 5
+
+def test_refused_deduction_reports_balance_before_attempt(engine, db):
+    user = _create_user(db, 5)
+    # 另一个请求在本次扣除之前改动了余额，提示信息仍使用本请求看到的余额
+    other = sessionmaker(bind=engine)()
+    other.get(User, user.id).credits = 8
+    other.commit()
+    other.close()
+
+    assert deduct_user_credits_atomic(db, user, 10) is None
+    assert user.credits == 5
+
+def test_concurrent_deductions_never_overdraw(engine):
+    sessions = [sessionmaker(bind=engine)() for _ in range(3)]
+    user_id = _create_user(sessions[0], 20).id
+    # 三个会话各自持有读取到20积分的用户对象，只有两次扣除能成功
+    users = [session.get(User, user_id) for session in sessions]
+
+    results = [deduct_user_credits_atomic(session, u, 10) for session, u in zip(sessions, users)]
+
+    assert results == [10, 0, None]
+    for session in sessions:
+        session.close()
+    check = sessionmaker(bind=engine)()
+    assert check.get(User, user_id).credits == 0
+    check.close()
@@ -0,0 +1,79 @@
+"""
+解码结果缓存 _DecodeCache 的测试
+"""
+
+import io
+
+from PIL import Image
+
+from app.config import settings
+from app.services.image_processing import ImageProcessingService, _DecodeCache
+
+def _image(side: int, mode: str = 'RGB') -> Image.Image:
+    return Image.new(mode, (side, side))
+
+def test_evicts_least_recently_used_by_entries():
+    cache = _DecodeCache(max_entries=2, max_bytes=1024 * 1024)
+    cache.put('a', _image(4))
+    cache.put('b', _image(4))
+    # 访问a之后，b成为最久未使用的条目
+    assert cache.get('a') is not None
+    cache.put('c', _image(4))
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+
+def test_byte_budget_limits_total_size():
+    # 10x10 RGB 为300字节，预算只够放两张
+    cache = _DecodeCache(max_entries=8, max_bytes=700)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, _image(10))
+
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
+    assert cache._bytes == 600
+
+    # 灰度图按单通道计算（100字节），正好放得下
+    cache.put('gray', _image(10, 'L'))
+    assert cache._bytes == 700
+    assert cache.get('b') is not None
+
+    # 超出预算时淘汰最久未使用的c
+    cache.put('gray2', _image(10, 'L'))
+    assert cache.get('c') is None
+    assert cache._bytes == 500
+
+def test_image_larger_than_budget_is_not_cached():
+    cache = _DecodeCache(max_entries=8, max_bytes=700)
+    cache.put('a', _image(10))
+    cache.put('huge', _image(20))
+
+    assert cache.get('huge') is None
+    assert cache.get('a') is not None
+
+def test_key_depends_on_decode_mode():
+    data = b'same bytes'
+    assert _DecodeCache.key(data, False) != _DecodeCache.key(data, True)
+    assert _DecodeCache.key(data) == _DecodeCache.key(bytes(data))
+
+def test_zero_budget_disables_cache(monkeypatch):
+    monkeypatch.setattr(settings, 'decode_cache_max_mb', 0)
+    service = ImageProcessingService()
+    buffer = io.BytesIO()
+    _image(8).save(buffer, format='PNG')
+
+    first = service._decode_image_cached(buffer.getvalue())
+    second = service._decode_image_cached(buffer.getvalue())
+
+    assert not service._decode_cache.enabled
+    assert first is not second
+    assert not service._decode_cache._items
+
+def test_service_reuses_cached_decode():
+    service = ImageProcessingService()
+    buffer = io.BytesIO()
+    _image(8).save(buffer, format='PNG')
+
+    assert service._decode_image_cached(buffer.getvalue()) is service._decode_image_cached(buffer.getvalue())
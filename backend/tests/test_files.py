@@ -0,0 +1,93 @@
+"""
+/api/files/{filename} 的条件请求与分段请求测试
+"""
+
+import os
+import pytest
+from fastapi import HTTPException
+
+from app.routers import image_processing as router_module
+
+CONTENT = bytes(range(256)) * 4
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    """把上传目录指向临时目录，并放入一个测试文件"""
+    directory = os.path.realpath(tmp_path)
+    monkeypatch.setattr(router_module, '_UPLOADS_DIR_ABS', directory)
+    monkeypatch.setattr(router_module, '_UPLOADS_PREFIX', os.path.join(directory, ''))
+    with open(os.path.join(directory, 'result.png'), 'wb') as f:
+        f.write(CONTENT)
+    return directory
+
+def test_get_file_returns_validators(client, upload_dir):
+    response = client.get('/api/files/result.png')
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers['etag'].startswith('"')
+    assert response.headers['accept-ranges'] == 'bytes'
+    assert 'last-modified' in response.headers
+
+def test_if_none_match_returns_304(client, upload_dir):
+    etag = client.get('/api/files/result.png').headers['etag']
+
+    for header in (etag, f'W/{etag}', f'"other", {etag}', '*'):
+        response = client.get('/api/files/result.png', headers={'If-None-Match': header})
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers['etag'] == etag
+
+def test_if_none_match_mismatch_returns_body(client, upload_dir):
+    response = client.get('/api/files/result.png', headers={'If-None-Match': '"stale"'})
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+def test_range_with_matching_if_range_returns_206(client, upload_dir):
+    etag = client.get('/api/files/result.png').headers['etag']
+
+    response = client.get('/api/files/result.png', headers={'Range': 'bytes=10-19', 'If-Range': etag})
+
+    assert response.status_code == 206
+    assert response.content == CONTENT[10:20]
+    assert response.headers['content-range'] == f'bytes 10-19/{len(CONTENT)}'
+
+def test_range_with_stale_if_range_returns_full_file(client, upload_dir):
+    response = client.get('/api/files/result.png', headers={'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+def test_etag_changes_when_file_changes(client, upload_dir):
+    etag = client.get('/api/files/result.png').headers['etag']
+    path = os.path.join(upload_dir, 'result.png')
+    with open(path, 'ab') as f:
+        f.write(b'more')
+
+    response = client.get('/api/files/result.png', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+
+def test_path_traversal_is_rejected(upload_dir):
+    # 编码后的斜杠在路由层就不会匹配，这里直接检查解码后的文件名
+    with pytest.raises(HTTPException) as exc_info:
+        router_module._resolve_upload_path('../../etc/passwd')
+
+    assert exc_info.value.status_code == 400
+
+def test_symlink_out_of_upload_dir_is_rejected(upload_dir, tmp_path_factory):
+    outside = tmp_path_factory.mktemp('outside') / 'secret.png'
+    outside.write_bytes(CONTENT)
+    os.symlink(outside, os.path.join(upload_dir, 'link.png'))
+
+    with pytest.raises(HTTPException) as exc_info:
+        router_module._resolve_upload_path('link.png')
+
+    assert exc_info.value.status_code == 400
+
+def test_missing_file_returns_404(client, upload_dir):
+    response = client.get('/api/files/missing.png')
+
+    assert response.status_code == 404
@@ -0,0 +1,72 @@
+"""
+ComfyUI不可用时吉卜力风格降级滤镜的测试
+"""
+
+import asyncio
+import io
+import pytest
+from PIL import Image
+
+from app.services.image_processing import GhibliStyleProcessor, image_processing_service
+
+@pytest.fixture
+def processor(monkeypatch):
+    """ComfyUI调用一律失败的吉卜力处理器"""
+    processor = image_processing_service.processors['ghibli_style']
+
+    async def unavailable(image, task_id=None):
+        raise ConnectionError("ComfyUI unavailable")
+
+    monkeypatch.setattr(processor, '_call_comfyui_ghibli_api', unavailable)
+    return processor
+
+def _palette_image(size) -> Image.Image:
+    """左半边为调色板索引1（红色）、右半边为索引0（黑色）的P模式图像"""
+    image = Image.new('P', size, 0)
+    image.putpalette([0, 0, 0, 255, 0, 0] + [0, 0, 0] * 254)
+    image.paste(1, (0, 0, size[0] // 2, size[1]))
+    return image
+
+@pytest.mark.parametrize('size', [(64, 48), (320, 300)])
+def test_fallback_accepts_rgba(processor, size):
+    image = Image.new('RGBA', size, (40, 120, 200, 128))
+
+    result = asyncio.run(processor.process(image))
+
+    assert isinstance(result, Image.Image)
+    assert result.mode == 'RGB'
+    assert result.size == size
+
+@pytest.mark.parametrize('size', [(64, 48), (320, 300)])
+def test_fallback_uses_palette_colors(processor, size):
+    result = asyncio.run(processor.process(_palette_image(size)))
+
+    assert result.mode == 'RGB'
+    assert result.size == size
+    # 按调色板颜色处理：红色区域仍是红色，而不是把索引值当作灰度
+    red, green, blue = result.getpixel((2, size[1] // 2))
+    assert red > 200 and green < 60 and blue < 60
+    assert result.getpixel((size[0] - 3, size[1] // 2))[0] < 60
+
+@pytest.mark.parametrize('mode', ['RGBA', 'P'])
+def test_process_image_falls_back_to_encoded_output(processor, mode):
+    image = _palette_image((96, 64)) if mode == 'P' else Image.new('RGBA', (96, 64), (200, 30, 30, 255))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+
+    output, _ = asyncio.run(image_processing_service.process_image(buffer.getvalue(), 'ghibli_style'))
+
+    result = Image.open(io.BytesIO(output))
+    assert result.format == 'PNG'
+    assert result.mode == 'RGB'
+    assert result.size == (96, 64)
+
+def test_fallback_filter_is_deterministic():
+    image = Image.new('RGB', (40, 30), (100, 150, 200))
+
+    first = GhibliStyleProcessor()._fallback_ghibli_style(image)
+    second = GhibliStyleProcessor()._fallback_ghibli_style(image)
+
+    assert first.tobytes() == second.tobytes()
+    # 对比度查表：100*1.2+10=130，150*1.2+10=190，200*1.2+10=250
+    assert first.getpixel((20, 15)) == (130, 190, 250)
@@ -0,0 +1,143 @@
+"""
+/api/progress/{task_id}/stream 的SSE推送测试
+"""
+
+import json
+
+from app.routers import image_processing as router_module
+from app.utils.redis_client import redis_client, task_progress_manager
+
+class FakePubSub:
+    """按顺序返回预置消息的异步PubSub替身，消息为None时模拟等待超时"""
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.channels = []
+        self.closed = False
+
+    async def subscribe(self, channel):
+        self.channels.append(channel)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+        message = self.messages.pop(0) if self.messages else None
+        if message is None:
+            return None
+        return {'type': 'message', 'data': json.dumps(message)}
+
+    async def aclose(self):
+        self.closed = True
+
+def _events(body: str):
+    return [
+        json.loads(line[len('data: '):])
+        for line in body.splitlines()
+        if line.startswith('data: ')
+    ]
+
+def test_stream_pushes_progress_until_completed(client, monkeypatch):
+    pubsub = FakePubSub([
+        {'status': 'processing', 'progress': 50, 'message': '处理中'},
+        {'status': 'completed', 'progress': 100, 'result_url': '/api/files/out.png'},
+    ])
+    monkeypatch.setattr(redis_client, 'pubsub_async', lambda: pubsub)
+    monkeypatch.setattr(
+        task_progress_manager, 'get_progress',
+        lambda task_id: {'status': 'pending', 'progress': 0, 'message': '排队中'}
+    )
+
+    response = client.get('/api/progress/task-1/stream')
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = _events(response.text)
+    assert [event['status'] for event in events] == ['pending', 'processing', 'completed']
+    assert [event['progress'] for event in events] == [0, 50, 100]
+    assert all(event['task_id'] == 'task-1' for event in events)
+    assert events[-1]['result_url'] == '/api/files/out.png'
+    assert pubsub.channels == [task_progress_manager.channel('task-1')]
+    assert pubsub.closed
+
+def test_stream_sends_keep_alive_while_idle(client, monkeypatch):
+    pubsub = FakePubSub([None, {'status': 'failed', 'error': 'boom'}])
+    monkeypatch.setattr(redis_client, 'pubsub_async', lambda: pubsub)
+    monkeypatch.setattr(task_progress_manager, 'get_progress', lambda task_id: {'status': 'processing'})
+
+    response = client.get('/api/progress/task-2/stream')
+
+    assert ': keep-alive' in response.text
+    assert [event['status'] for event in _events(response.text)] == ['processing', 'failed']
+
+def test_stream_ends_when_progress_expires(client, monkeypatch):
+    # 进度记录过期后不会再有推送，超时重读发现记录不存在即结束连接
+    pubsub = FakePubSub([None, None, None])
+    progress = iter([{'status': 'processing', 'progress': 10}, None])
+    monkeypatch.setattr(redis_client, 'pubsub_async', lambda: pubsub)
+    monkeypatch.setattr(task_progress_manager, 'get_progress', lambda task_id: next(progress))
+
+    response = client.get('/api/progress/task-6/stream')
+
+    assert [event['status'] for event in _events(response.text)] == ['processing']
+    assert ': keep-alive' not in response.text
+    assert pubsub.closed
+
+def test_stream_picks_up_missed_final_status(client, monkeypatch):
+    pubsub = FakePubSub([None])
+    progress = iter([{'status': 'processing'}, {'status': 'completed', 'result_url': '/api/files/x.png'}])
+    monkeypatch.setattr(redis_client, 'pubsub_async', lambda: pubsub)
+    monkeypatch.setattr(task_progress_manager, 'get_progress', lambda task_id: next(progress))
+
+    response = client.get('/api/progress/task-7/stream')
+
+    events = _events(response.text)
+    assert [event['status'] for event in events] == ['processing', 'completed']
+    assert events[-1]['result_url'] == '/api/files/x.png'
+
+def test_stream_stops_at_max_duration(client, monkeypatch):
+    pubsub = FakePubSub([None])
+    monkeypatch.setattr(router_module, '_SSE_MAX_SECONDS', 0)
+    monkeypatch.setattr(redis_client, 'pubsub_async', lambda: pubsub)
+    monkeypatch.setattr(task_progress_manager, 'get_progress', lambda task_id: {'status': 'processing'})
+
+    response = client.get('/api/progress/task-8/stream')
+
+    assert [event['status'] for event in _events(response.text)] == ['processing']
+    assert pubsub.messages == [None]
+    assert pubsub.closed
+
+def test_stream_finished_task_sends_single_event(client, monkeypatch):
+    pubsub = FakePubSub([])
+    monkeypatch.setattr(redis_client, 'pubsub_async', lambda: pubsub)
+    monkeypatch.setattr(task_progress_manager, 'get_progress', lambda task_id: {'status': 'completed', 'progress': 100})
+
+    response = client.get('/api/progress/task-3/stream')
+
+    assert [event['status'] for event in _events(response.text)] == ['completed']
+    assert pubsub.closed
+
+def test_stream_unknown_task_returns_404(client, monkeypatch):
+    pubsub = FakePubSub([])
+    monkeypatch.setattr(redis_client, 'pubsub_async', lambda: pubsub)
+    monkeypatch.setattr(task_progress_manager, 'get_progress', lambda task_id: None)
+
+    response = client.get('/api/progress/missing/stream')
+
+    assert response.status_code == 404
+    assert pubsub.closed
+
+def test_stream_without_redis_falls_back_to_polling(client, monkeypatch):
+    # Redis未连接时 pubsub_async 返回None，接口返回503提示客户端改用轮询
+    monkeypatch.setattr(redis_client, 'redis_client', None)
+
+    response = client.get('/api/progress/task-4/stream')
+
+    assert response.status_code == 503
+    assert '轮询' in response.json()['detail']
+
+def test_polling_endpoint_serves_same_payload(client, monkeypatch):
+    progress = {'status': 'processing', 'progress': 30, 'message': '处理中'}
+    monkeypatch.setattr(task_progress_manager, 'get_progress', lambda task_id: progress)
+
+    response = client.get('/api/progress/task-5')
+
+    assert response.status_code == 200
+    assert response.json() == router_module._progress_payload('task-5', progress)
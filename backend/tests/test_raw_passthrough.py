@@ -0,0 +1,80 @@
+"""
+处理器输出格式与目标格式相同时原样返回后端数据的测试
+"""
+
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+from app.config import settings
+from app.services.image_processing import image_processing_service
+
+def _encode(image: Image.Image, format: str) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+INPUT_PNG = _encode(Image.new('RGB', (32, 24), (10, 200, 30)), 'PNG')
+COMFYUI_PNG = _encode(Image.new('RGB', (32, 24), (200, 100, 50)), 'PNG')
+
+@pytest.fixture
+def comfyui_output(monkeypatch):
+    """让吉卜力处理器的ComfyUI调用返回指定数据，调用次数记录在返回的列表里"""
+    processor = image_processing_service.processors['ghibli_style']
+    monkeypatch.setattr(settings, 'lossless_output_format', 'png')
+    calls = []
+
+    def use(data):
+        async def call(image, task_id=None):
+            calls.append(task_id)
+            if isinstance(data, Exception):
+                raise data
+            return bytearray(data)
+
+        monkeypatch.setattr(processor, '_call_comfyui_ghibli_api', call)
+        return calls
+
+    return use
+
+def _process(output_format=None):
+    return asyncio.run(image_processing_service.process_image(
+        INPUT_PNG, 'ghibli_style', task_id='task-1', output_format=output_format
+    ))[0]
+
+def test_matching_format_is_passed_through(comfyui_output):
+    calls = comfyui_output(COMFYUI_PNG)
+
+    result = _process()
+
+    assert bytes(result) == COMFYUI_PNG
+    assert calls == ['task-1']
+
+def test_other_format_is_reencoded(comfyui_output):
+    comfyui_output(COMFYUI_PNG)
+
+    result = _process('jpeg')
+
+    image = Image.open(io.BytesIO(result))
+    assert image.format == 'JPEG'
+    assert image.size == (32, 24)
+
+def test_unexpected_backend_format_is_reencoded(comfyui_output):
+    # 后端返回的不是声明的PNG时不能原样返回，解码后按目标格式重新编码
+    comfyui_output(_encode(Image.new('RGB', (32, 24), (200, 100, 50)), 'JPEG'))
+
+    result = _process()
+
+    image = Image.open(io.BytesIO(result))
+    assert image.format == 'PNG'
+    assert image.size == (32, 24)
+
+def test_fallback_image_is_encoded(comfyui_output):
+    comfyui_output(ConnectionError("ComfyUI unavailable"))
+
+    result = _process()
+
+    image = Image.open(io.BytesIO(result))
+    assert image.format == 'PNG'
+    assert image.size == (32, 24)
@@ -0,0 +1,69 @@
+"""
+文生图攒批测试：参数相同的请求合并为一个batch任务，结果按顺序分发给各请求
+"""
+
+import asyncio
+
+from PIL import Image
+
+from app.config import settings
+from app.services.image_processing import TextToImageProcessor
+
+def _run_requests(monkeypatch, prompts, max_batch=3, window_ms=20):
+    """并发提交多个文生图请求，返回 (各请求结果, _generate 收到的批次)"""
+    monkeypatch.setattr(settings, 'comfyui_max_batch', max_batch)
+    monkeypatch.setattr(settings, 'comfyui_batch_window_ms', window_ms)
+    processor = TextToImageProcessor()
+    batches = []
+
+    async def generate(params, task_ids):
+        prompt = params[0]
+        batches.append((prompt, list(task_ids)))
+        await asyncio.sleep(0)
+        if prompt == 'bad':
+            raise RuntimeError("ComfyUI 执行出错")
+        return [bytearray(f"{prompt}-{index}".encode()) for index in range(len(task_ids))]
+
+    monkeypatch.setattr(processor, '_generate', generate)
+
+    async def main():
+        return await asyncio.gather(*(
+            processor.process_raw(parameters={'prompt': prompt}, task_id=f"task-{index}")
+            for index, prompt in enumerate(prompts)
+        ))
+
+    results = asyncio.run(main())
+    assert not processor._pending
+    return results, batches
+
+def test_identical_prompts_share_one_job(monkeypatch):
+    # 凑满3个立即提交，剩下2个等窗口到期后提交
+    results, batches = _run_requests(monkeypatch, ['cat'] * 5)
+
+    assert batches == [
+        ('cat', ['task-0', 'task-1', 'task-2']),
+        ('cat', ['task-3', 'task-4']),
+    ]
+    assert [bytes(result) for result in results] == [b'cat-0', b'cat-1', b'cat-2', b'cat-0', b'cat-1']
+
+def test_failed_batch_only_affects_its_requests(monkeypatch):
+    results, batches = _run_requests(monkeypatch, ['cat', 'bad', 'cat', 'bad', 'dog'])
+
+    assert sorted(batches) == [
+        ('bad', ['task-1', 'task-3']),
+        ('cat', ['task-0', 'task-2']),
+        ('dog', ['task-4']),
+    ]
+    assert bytes(results[0]) == b'cat-0'
+    assert bytes(results[2]) == b'cat-1'
+    assert bytes(results[4]) == b'dog-0'
+    # 出错批次里的每个请求都各自降级为占位图
+    for result in (results[1], results[3]):
+        assert isinstance(result, Image.Image)
+        assert result.size == (512, 512)
+
+def test_batching_disabled_submits_each_request(monkeypatch):
+    results, batches = _run_requests(monkeypatch, ['cat', 'cat'], max_batch=1)
+
+    assert batches == [('cat', ['task-0']), ('cat', ['task-1'])]
+    assert [bytes(result) for result in results] == [b'cat-0', b'cat-0']
@@ -363,7 +363,57 @@ export const useGhibliStore = defineStore('ghibli', {
       }
     },
 
+    streamTaskProgress(taskId: string): Promise<string | null> {
+      // 通过SSE接收进度推送；连接不可用时返回null，由调用方退回轮询
+      return new Promise((resolve, reject) => {
+        const source = new EventSource(`${API_BASE_URL}/api/progress/${taskId}/stream`)
+        const maxStreamMs = 300 * 1000 // 与轮询一致，最多等待5分钟
+        const deadline = setTimeout(() => {
+          source.close()
+          resolve(null)
+        }, maxStreamMs)
+        
+        source.onmessage = (event) => {
+          const data: ProgressResponse = JSON.parse(event.data)
+          
+          // 更新任务状态
+          if (this.currentTask && this.currentTask.taskId === taskId) {
+            this.currentTask.progress = data.progress
+            this.currentTask.status = data.status
+            this.currentTask.message = data.message
+          }
+          
+          if (data.status === 'completed' && data.result_url) {
+            source.close()
+            clearTimeout(deadline)
+            // 确保图片URL包含完整的后端地址
+            resolve(data.result_url.startsWith('http')
+              ? data.result_url
+              : `${API_BASE_URL}${data.result_url}`)
+          } else if (data.status === 'failed') {
+            source.close()
+            clearTimeout(deadline)
+            reject(new Error(data.error || '图像生成失败'))
+          }
+        }
+        
+        source.onerror = () => {
+          source.close()
+          clearTimeout(deadline)
+          resolve(null)
+        }
+      })
+    },
+
     async pollTaskProgress(taskId: string): Promise<string> {
+      // 优先使用SSE推送，不支持或连接失败时退回轮询
+      if (typeof EventSource !== 'undefined') {
+        const streamedUrl = await this.streamTaskProgress(taskId)
+        if (streamedUrl) {
+          return streamedUrl
+        }
+      }
+      
       const maxPolls = 300 // 最多轮询5分钟 (300 * 1秒)
       let polls = 0
       